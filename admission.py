@@ -0,0 +1,158 @@
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# **Take a Slot if the User Is under the Cap, Otherwise Park the Job**
+# KEYS[1] = in-flight counter, KEYS[2] = pending list; ARGV = cap, job, ttl
+# Parking leaves the counter's TTL alone, so a slot leaked by a crashed job still expires while
+# the user keeps sending. The pending list has no TTL, parked jobs are only removed by RELEASE
+# and REAP, never lost to an expiry while the user's running job takes long.
+SUBMIT_SCRIPT = """
+local in_flight = tonumber(redis.call('GET', KEYS[1]) or '0')
+if in_flight < tonumber(ARGV[1]) then
+    redis.call('INCR', KEYS[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+end
+redis.call('RPUSH', KEYS[2], ARGV[2])
+return 0
+"""
+
+# **Hand the Freed Slot to the Next Parked Job, or Give It Back**
+# KEYS[1] = in-flight counter, KEYS[2] = pending list; ARGV = ttl
+RELEASE_SCRIPT = """
+local job = redis.call('LPOP', KEYS[2])
+if job then
+    redis.call('SET', KEYS[1], math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), 1), 'EX', ARGV[1])
+    return job
+end
+if tonumber(redis.call('DECR', KEYS[1])) <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+return false
+"""
+
+# **Drop Jobs Parked for Too Long and Admit Parked Jobs into Free Slots**
+# KEYS[1] = in-flight counter, KEYS[2] = pending list; ARGV = cap, ttl, now, max wait (0 keeps jobs)
+# Slots free up without a release when the counter of a crashed or very long job expires.
+# Returns {dropped jobs, admitted jobs}.
+REAP_SCRIPT = """
+local dropped = {}
+local max_wait = tonumber(ARGV[4])
+while max_wait > 0 do
+    local job = redis.call('LINDEX', KEYS[2], 0)
+    if not job or (cjson.decode(job)['parked_at'] or 0) + max_wait > tonumber(ARGV[3]) then
+        break
+    end
+    table.insert(dropped, redis.call('LPOP', KEYS[2]))
+end
+local in_flight = tonumber(redis.call('GET', KEYS[1]) or '0')
+local admitted = {}
+while in_flight < tonumber(ARGV[1]) do
+    local job = redis.call('LPOP', KEYS[2])
+    if not job then
+        break
+    end
+    in_flight = in_flight + 1
+    table.insert(admitted, job)
+end
+if #admitted > 0 then
+    redis.call('SET', KEYS[1], in_flight, 'EX', ARGV[2])
+end
+return {dropped, admitted}
+"""
+
+
+# **Per-User Admission Control**
+# Each user may have at most `limits[kind]` jobs of a kind in the broker at once; further jobs
+# wait in a per-user Redis list and are dispatched one by one as that user's jobs finish.
+# Since no user can flood a queue, jobs of different users interleave in the broker.
+class AdmissionControl:
+    IN_FLIGHT_KEY = "admission:{}:{}:in_flight"
+    PENDING_KEY = "admission:{}:{}:pending"
+
+    def __init__(self, redis_client, celery_app, limits, ttl=3600, max_wait=6 * 3600, on_dropped=None):
+        self.redis = redis_client
+        self.celery_app = celery_app
+        self.limits = limits
+        self.ttl = ttl  # Slots of crashed jobs are forgotten this many seconds after their job was dispatched or started
+        self.max_wait = max_wait  # Parked jobs are dropped after this many seconds, 0 keeps them
+        self.on_dropped = on_dropped  # Called with each dropped job, to tell its user
+        self._submit = redis_client.register_script(SUBMIT_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+        self._reap = redis_client.register_script(REAP_SCRIPT)
+
+    def _keys(self, kind, user_id):
+        return [self.IN_FLIGHT_KEY.format(kind, user_id), self.PENDING_KEY.format(kind, user_id)]
+
+    def _dispatch(self, job):
+        return self.celery_app.send_task(
+            job["task"], args=job["args"], headers={"admission": [job["kind"], job["user_id"]]}
+        )
+
+    def submit(self, task, kind, user_id, args):
+        # Returns the Celery AsyncResult, or None if the job was parked behind the user's other jobs
+        job = {"task": task.name, "kind": kind, "user_id": user_id, "args": list(args), "parked_at": time.time()}
+        limit = self.limits.get(kind, 0)
+        if limit <= 0:
+            return self._dispatch(job)
+        admitted = self._submit(keys=self._keys(kind, user_id), args=[limit, json.dumps(job), self.ttl])
+        if admitted:
+            return self._dispatch(job)
+        logger.info(f"User {user_id} is at the {kind} limit, job parked")
+        return None
+
+    def touch(self, kind, user_id):
+        # Restarts the slot's TTL when its job starts, so time spent queued in the broker does not count
+        if self.limits.get(kind, 0) > 0:
+            self.redis.expire(self._keys(kind, user_id)[0], self.ttl)
+
+    def release(self, kind, user_id):
+        if self.limits.get(kind, 0) <= 0:
+            return
+        job = self._release(keys=self._keys(kind, user_id), args=[self.ttl])
+        if job:
+            result = self._dispatch(json.loads(job))
+            logger.info(f"Dispatched parked {kind} job of user {user_id}: {result.id}")
+
+    # **Reaping**
+    def reap(self):
+        # Returns (dropped, admitted) job counts over all users
+        dropped_count = admitted_count = 0
+        for key in self.redis.scan_iter(match=self.PENDING_KEY.format("*", "*")):
+            key = key.decode() if isinstance(key, bytes) else key
+            _, kind, user_id, _ = key.split(":")
+            limit = self.limits.get(kind, 0)
+            dropped, admitted = self._reap(
+                keys=self._keys(kind, user_id), args=[max(limit, 1), self.ttl, time.time(), self.max_wait]
+            )
+            for job in dropped:
+                job = json.loads(job)
+                logger.warning(f"Dropped {kind} job of user {user_id} parked since {job.get('parked_at')}")
+                if self.on_dropped:
+                    try:
+                        self.on_dropped(job)
+                    except Exception as e:
+                        logger.error(f"Error reporting dropped {kind} job of user {user_id}: {e}")
+            for job in admitted:
+                result = self._dispatch(json.loads(job))
+                logger.info(f"Dispatched parked {kind} job of user {user_id} into a free slot: {result.id}")
+            dropped_count += len(dropped)
+            admitted_count += len(admitted)
+        return dropped_count, admitted_count
+
+    def start_reaper(self, interval=60):
+        def run():
+            while True:
+                try:
+                    self.reap()
+                except Exception as e:
+                    logger.error(f"Error in admission reaper: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="admission-reaper", daemon=True)
+        thread.start()
+        return thread
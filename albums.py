@@ -0,0 +1,100 @@
+import os
+import json
+import logging
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# **Hand the Album to Exactly One Caller once It Is Quiet**
+# KEYS = meta hash, images list, pending counter, deadline; ARGV[1] = retry delay in milliseconds
+# Returns {0} if the album is gone, {1, wait_ms} if photos may still arrive, {2, meta, images} to the claimer
+CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {0}
+end
+local wait = redis.call('PTTL', KEYS[4])
+if wait > 0 then
+    return {1, wait}
+end
+if tonumber(redis.call('GET', KEYS[3]) or '0') > 0 then
+    return {1, tonumber(ARGV[1])}
+end
+local meta = redis.call('HGETALL', KEYS[1])
+local images = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+return {2, meta, images}
+"""
+
+
+# **Albums Being Collected, Shared by All Bot Replicas through Redis**
+# Photos of one Telegram album may reach different bot processes. Each process adds its photos,
+# pushes the album's deadline `debounce` seconds ahead and then polls claim(); the album is handed
+# out once, to the first caller that finds no running download and the deadline passed.
+class AlbumBuffer:
+    META_KEY = "album:{}:meta"
+    IMAGES_KEY = "album:{}:images"
+    PENDING_KEY = "album:{}:pending"
+    DEADLINE_KEY = "album:{}:deadline"
+
+    def __init__(self, redis_client, debounce, ttl=3600):
+        self.redis = redis_client
+        self.debounce = debounce
+        self.ttl = ttl  # Albums abandoned by a crashed process are forgotten after this many seconds
+        self._claim = redis_client.register_script(CLAIM_SCRIPT)
+
+    def _keys(self, media_group_id):
+        return [key.format(media_group_id) for key in
+                (self.META_KEY, self.IMAGES_KEY, self.PENDING_KEY, self.DEADLINE_KEY)]
+
+    def open(self, media_group_id, user_id, folder, caption=None):
+        # Registers a running download and returns the album's folder (the first caller's one)
+        meta_key, images_key, pending_key, _ = self._keys(media_group_id)
+        pipe = self.redis.pipeline()
+        pipe.hsetnx(meta_key, "user_id", user_id)
+        pipe.hsetnx(meta_key, "folder", folder)
+        if caption:
+            pipe.hset(meta_key, "caption", caption)  # Telegram puts the album caption on one of its messages
+        pipe.incr(pending_key)
+        pipe.expire(meta_key, self.ttl)
+        pipe.expire(pending_key, self.ttl)
+        pipe.hget(meta_key, "folder")
+        return pipe.execute()[-1].decode("utf-8")
+
+    def add(self, media_group_id, images):
+        _, images_key, _, _ = self._keys(media_group_id)
+        pipe = self.redis.pipeline()
+        pipe.rpush(images_key, *(json.dumps(image) for image in images))
+        pipe.expire(images_key, self.ttl)
+        pipe.execute()
+
+    def close(self, media_group_id):
+        # Marks a download as finished and restarts the debounce window
+        _, _, pending_key, deadline_key = self._keys(media_group_id)
+        pipe = self.redis.pipeline()
+        pipe.decr(pending_key)
+        pipe.set(deadline_key, 1, px=max(1, int(self.debounce * 1000)))
+        pipe.execute()
+
+    def claim(self, media_group_id):
+        # Returns (album, None) to the single claimer, (None, seconds to wait) while the album is
+        # still open, and (None, None) once another caller has claimed it
+        result = self._claim(keys=self._keys(media_group_id), args=[int(self.debounce * 1000)])
+        if result[0] == 0:
+            return None, None
+        if result[0] == 1:
+            return None, result[1] / 1000
+        meta = {key.decode("utf-8"): value.decode("utf-8") for key, value in zip(result[1][::2], result[1][1::2])}
+        album = {
+            "user_id": int(meta["user_id"]),
+            "folder": meta["folder"],
+            "caption": meta.get("caption"),
+            "images": [json.loads(image) for image in result[2]],
+        }
+        return album, None
+
+
+# **Function to Create the Album Buffer**
+def create_album_buffer(debounce):
+    redis_url = os.getenv("ALBUMS_REDIS_URL", os.getenv("CELERY_BACKEND_URL", "redis://redis:6379/0"))
+    return AlbumBuffer(redis.Redis.from_url(redis_url), debounce)
@@ -0,0 +1,283 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import zipfile
+
+from PIL import Image
+
+# **Benchmark Suite for the Resize Pipeline**
+# Generates synthetic archives, runs the Celery task bodies locally in eager mode with the
+# Telegram Bot API stubbed out, and reports throughput, per-stage time, peak RSS and output
+# bytes as JSON. Every run of a scenario happens in a fresh subprocess, so peak RSS is per run.
+#
+#   python benchmarks/bench.py --output results.json
+#   python benchmarks/bench.py --output new.json --compare results.json
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# **Scenarios**
+# Sizes are (width, height); the default tolerance of 0.15 accepts near-square sources only,
+# so "mixed" scenarios also measure how cheaply rejected images are skipped.
+SCENARIOS = [
+    {"name": "zip-jpeg-small", "task": "archive", "archive": "zip", "count": 40, "size": (1200, 1200), "format": "JPEG"},
+    {"name": "zip-jpeg-large", "task": "archive", "archive": "zip", "count": 12, "size": (4000, 4000), "format": "JPEG"},
+    {"name": "zip-png", "task": "archive", "archive": "zip", "count": 20, "size": (1600, 1600), "format": "PNG"},
+    {"name": "zip-webp", "task": "archive", "archive": "zip", "count": 20, "size": (1600, 1600), "format": "WEBP"},
+    {"name": "zip-mixed-aspect", "task": "archive", "archive": "zip", "count": 40, "size": (2000, 2000),
+     "format": "JPEG", "mixed_aspect": True},
+    {"name": "zip-presets", "task": "archive", "archive": "zip", "count": 20, "size": (3000, 3000), "format": "JPEG",
+     "presets": [["marketplace", 900, 1200], ["small", 600, 800], ["thumb", 300, 400]]},
+    {"name": "rar-jpeg", "task": "archive", "archive": "rar", "count": 20, "size": (2000, 2000), "format": "JPEG"},
+    {"name": "album-jpeg", "task": "images", "count": 10, "size": (2400, 2400), "format": "JPEG"},
+]
+
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+
+
+# **Function to Draw a Reproducible Synthetic Photo**
+# A small random tile upscaled with bicubic filtering gives smooth, photo-like content that
+# compresses realistically, unlike pure noise or flat colour.
+def synthetic_image(rng, size):
+    tile = Image.frombytes("RGB", (16, 12), rng.randbytes(16 * 12 * 3))
+    return tile.resize(size, Image.Resampling.BICUBIC)
+
+
+# **Function to Generate the Input Files of a Scenario**
+def generate_inputs(scenario, folder, seed):
+    rng = random.Random(f"{seed}-{scenario['name']}")
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    width, height = scenario["size"]
+    for index in range(scenario["count"]):
+        size = (width, height // 2) if scenario.get("mixed_aspect") and index % 3 == 0 else (width, height)
+        buffer = io.BytesIO()
+        synthetic_image(rng, size).save(buffer, scenario["format"], quality=90)
+        path = os.path.join(folder, f"image_{index:04d}{FORMAT_EXTENSIONS[scenario['format']]}")
+        with open(path, "wb") as f:
+            f.write(buffer.getvalue())
+        paths.append(path)
+    return paths
+
+
+# **Function to Pack Generated Images into a ZIP or RAR Archive**
+# Returns None for RAR when the rar binary is not installed.
+def build_archive(scenario, image_paths, archive_path):
+    if scenario["archive"] == "rar":
+        rar = shutil.which("rar")
+        if rar is None:
+            return None
+        subprocess.run([rar, "a", "-ep", "-idq", archive_path, *image_paths], check=True)
+        return archive_path
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        for path in image_paths:
+            archive.write(path, os.path.join("images", os.path.basename(path)))
+    return archive_path
+
+
+# **Stub of the Bot API Client Recording What Would Be Sent**
+class StubBotApi:
+    def __init__(self):
+        self.calls = 0
+        self.output_bytes = 0
+
+    def _record(self, document):
+        self.calls += 1
+        if not isinstance(document, str):
+            document.seek(0)
+            self.output_bytes += len(document.read())
+        return {"document": {"file_id": f"stub-{self.calls}"}}
+
+    def send_message(self, chat_id, text, parse_mode="HTML"):
+        self.calls += 1
+
+    def edit_message_text(self, chat_id, message_id, text, parse_mode="HTML"):
+        self.calls += 1
+
+    def send_document(self, chat_id, document, caption=None, filename=None, parse_mode="HTML"):
+        return self._record(document)
+
+    def send_media_group(self, chat_id, documents):
+        return [self._record(document) for _, document, _ in documents]
+
+
+# **Function to Run One Scenario Inside the Current Process**
+# Called in a fresh subprocess; the environment is set up before tasks.py is imported.
+def run_scenario(scenario, inputs, workdir, archive_workers):
+    os.environ.setdefault("BOT_TOKEN", "benchmark")
+    os.environ["STATS_BACKEND"] = "sqlite"
+    os.environ["STATS_DB"] = os.path.join(workdir, "stats.db")
+    os.environ["TEMP_DIR"] = os.path.join(workdir, "temp")
+    os.environ["WORKER_METRICS_PORT"] = "0"
+    os.environ["CHECKPOINT_TTL"] = "0"  # No Redis needed
+    os.environ["ARCHIVE_WORKERS"] = str(archive_workers)
+    sys.path.insert(0, REPO_DIR)
+
+    import tasks
+    from cache import ResultCache
+    from metrics import StageTimer
+
+    timers = []
+
+    # **Collect the Stage Timers Created by the Task**
+    class RecordingTimer(StageTimer):
+        def __init__(self, task):
+            super().__init__(task)
+            timers.append(self)
+
+    tasks.StageTimer = RecordingTimer
+    tasks.celery_app.conf.task_always_eager = True
+    tasks.result_cache = ResultCache(os.path.join(workdir, "cache"), 0)  # Measure real work, not cache hits
+    tasks.bot_api = StubBotApi()
+
+    # **Work on a Copy, the Tasks Delete Their Inputs**
+    job_folder = os.path.join(workdir, "temp", "job")
+    shutil.rmtree(job_folder, ignore_errors=True)
+    os.makedirs(job_folder)
+    copies = []
+    for path in inputs:
+        copies.append(os.path.join(job_folder, os.path.basename(path)))
+        shutil.copyfile(path, copies[-1])
+
+    width, height, tolerance = 900, 1200, 0.15
+    presets = scenario.get("presets")
+    start = time.perf_counter()
+    if scenario["task"] == "archive":
+        tasks.process_archive_task.apply(args=[1, copies[0], width, height, tolerance, None, None, presets]).get()
+    else:
+        tasks.process_images_task.apply(args=[1, copies, width, height, tolerance, None, True, presets]).get()
+    seconds = time.perf_counter() - start
+
+    stages = {}
+    byte_counts = {}
+    for timer in timers:
+        for name, value in timer.timings.items():
+            stages[name] = round(stages.get(name, 0.0) + value, 4)
+        for name, value in timer.byte_counts.items():
+            byte_counts[name] = byte_counts.get(name, 0) + value
+
+    return {
+        "seconds": round(seconds, 4),
+        "images_per_sec": round(scenario["count"] / seconds, 2),
+        "stages": stages,
+        "bytes": byte_counts,
+        "output_bytes": tasks.bot_api.output_bytes,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+# **Function to Run a Scenario Several Times in Fresh Subprocesses**
+def measure(scenario, inputs, workdir, repeat, archive_workers):
+    runs = []
+    for _ in range(repeat):
+        command = [
+            sys.executable, os.path.abspath(__file__), "--child", json.dumps(scenario), json.dumps(inputs),
+            "--workdir", workdir, "--archive-workers", str(archive_workers)
+        ]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    median = statistics.median(run["seconds"] for run in runs)
+    result = dict(min(runs, key=lambda run: abs(run["seconds"] - median)))
+    result["seconds_runs"] = [run["seconds"] for run in runs]
+    result["peak_rss_kb"] = max(run["peak_rss_kb"] for run in runs)
+    return result
+
+
+# **Function to Print Changes against an Earlier Result File**
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {scenario["name"]: scenario for scenario in json.load(f)["scenarios"]}
+    print(f"\nCompared with {baseline_path}:")
+    for scenario in results["scenarios"]:
+        before = baseline.get(scenario["name"])
+        if before is None or "skipped" in scenario or "skipped" in before:
+            continue
+        for key in ("images_per_sec", "peak_rss_kb", "output_bytes"):
+            change = (scenario[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            print(f"  {scenario['name']:<20} {key:<15} {before[key]:>12} -> {scenario[key]:>12} ({change:+.1f}%)")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image resize pipeline")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against")
+    parser.add_argument("--scenario", action="append", help="Only run the named scenarios")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario, the median run is reported")
+    parser.add_argument("--archive-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", default="resizer", help="Seed of the synthetic inputs")
+    parser.add_argument("--workdir", help="Folder for generated inputs (a temporary folder by default)")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        scenario, inputs = (json.loads(value) for value in args.child)
+        print(json.dumps(run_scenario(scenario, inputs, args.workdir, args.archive_workers)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="resizer-bench-")
+    results = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "cpu_count": os.cpu_count(),
+        "archive_workers": args.archive_workers,
+        "repeat": args.repeat,
+        "scenarios": [],
+    }
+    try:
+        for scenario in SCENARIOS:
+            if args.scenario and scenario["name"] not in args.scenario:
+                continue
+            folder = os.path.join(workdir, scenario["name"])
+            image_paths = generate_inputs(scenario, folder, args.seed)
+            inputs = image_paths
+            if scenario["task"] == "archive":
+                archive_path = build_archive(scenario, image_paths, f"{folder}.{scenario['archive']}")
+                if archive_path is None:
+                    print(f"{scenario['name']:<20} skipped: rar binary not found")
+                    results["scenarios"].append({"name": scenario["name"], "skipped": "rar binary not found"})
+                    continue
+                inputs = [archive_path]
+
+            result = measure(scenario, inputs, workdir, args.repeat, args.archive_workers)
+            result["name"] = scenario["name"]
+            result["input_bytes"] = sum(os.path.getsize(path) for path in inputs)
+            results["scenarios"].append(result)
+            print(
+                f"{scenario['name']:<20} {result['images_per_sec']:>8.2f} images/s  {result['seconds']:>8.3f} s  "
+                f"peak RSS {result['peak_rss_kb'] // 1024:>5} MB  output {result['output_bytes'] // 1024:>7} KB"
+            )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
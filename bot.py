@@ -1,7 +1,7 @@
 import os
+import asyncio
 import zipfile
 import rarfile
-import json
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 import uuid
@@ -9,7 +9,15 @@ from dotenv import load_dotenv
 import shutil
 import logging
 
-from tasks import process_archive_task, process_images_task  # Import Celery tasks
+from tasks import admission, process_archive_task, process_images_task  # Import Celery tasks
+from tasks import TEMP_JANITOR_INTERVAL, TEMP_WAIT_TIMEOUT, temp_store
+from temp_store import TempStoreFullError
+from stats_store import create_stats_store, import_legacy_stats
+from metrics import StageTimer, start_metrics_server
+from prefs import create_user_prefs
+from encoders import ENCODER_PROFILES, parse_profile
+from albums import create_album_buffer
+from presets import DEFAULT_PRESETS, parse_presets, preset_sizes, select_presets
 
 # **Logging Configuration**
 logging.basicConfig(
@@ -24,9 +32,25 @@ TOKEN = os.getenv("BOT_TOKEN")
 ASPECT_RATIO_TOLERANCE = float(os.getenv("ASPECT_RATIO_TOLERANCE", 0.15))
 FINAL_WIDTH = int(os.getenv("FINAL_WIDTH", 900))
 FINAL_HEIGHT = int(os.getenv("FINAL_HEIGHT", 1200))
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", 0))
+# Bot API server, e.g. a local Bot API server or the fake one used for load tests
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", 1.5))  # Seconds to wait for more photos of an album
+# Let workers download files by file_id instead of sharing the bot's temp volume
+WORKER_DOWNLOADS = os.getenv("WORKER_DOWNLOADS", "false").lower() in ("1", "true", "yes")
+# **Webhook Mode**
+# With WEBHOOK_URL set the bot serves updates over HTTP, so several replicas can run behind a load balancer
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Checked against the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))  # Updates handled at once per process
+PRESETS = parse_presets(os.getenv("PRESETS", DEFAULT_PRESETS))  # Named output sizes users can pick
 
 # **Directories Setup**
-TEMP_DIR = "/app/temp"
+TEMP_DIR = os.getenv("TEMP_DIR", "/app/temp")  # Shared with the workers, see TEMP_QUOTA_BYTES
 STATS_DIR = "/app/stats"
 STATS_FILE = os.path.join(STATS_DIR, "stats.json")
 
@@ -34,27 +58,24 @@ STATS_FILE = os.path.join(STATS_DIR, "stats.json")
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(STATS_DIR, exist_ok=True)
 
-# **Initialize Statistics**
-def load_stats():
-    if not os.path.exists(STATS_FILE):
-        stats = {
-            "users": [],
-            "archives": 0,
-            "images": 0,
-            "resizes": 0,
-            "top_archives": []
-        }
-        save_stats(stats)
-    else:
-        with open(STATS_FILE, "r", encoding="utf-8") as f:
-            stats = json.load(f)
-    return stats
-
-def save_stats(stats):
-    with open(STATS_FILE, "w", encoding="utf-8") as f:
-        json.dump(stats, f, ensure_ascii=False, indent=4)
-
-stats = load_stats()
+# **Initialize Statistics and Preferences Stores**
+stats = create_stats_store()
+prefs = create_user_prefs()
+
+# **Albums Being Collected in Redis, Shared by All Bot Replicas**
+albums = create_album_buffer(ALBUM_DEBOUNCE)
+album_flushes = {}  # media_group_id -> this process's task waiting to claim the album
+
+# **Function to Resolve the Output Sizes of a Request**
+# Presets named in the caption win over the user's saved choice; without either, FINAL_WIDTH x FINAL_HEIGHT
+# is used. Returns the width, height and preset list passed to the Celery tasks.
+def output_sizes(user_id, caption=None):
+    names = select_presets(caption, PRESETS) or select_presets(prefs.get(user_id, "presets"), PRESETS)
+    if not names:
+        return FINAL_WIDTH, FINAL_HEIGHT, None
+    sizes = preset_sizes(names, PRESETS)
+    _, width, height = sizes[0]
+    return width, height, sizes if len(sizes) > 1 else None
 
 # **Start Command Handler**
 async def start(update: Update, context):
@@ -65,6 +86,8 @@ async def start(update: Update, context):
         "2️⃣ Send individual images as <b>documents</b> (JPG, PNG, WEBP).\n"
         "I will resize the images from <b>1×1</b> to <b>3×4 (900×1200)</b> with a white background.\n"
         "✅ <b>Supported Formats:</b> <b>JPG</b>, <b>PNG</b>, <b>WEBP</b>.\n"
+        "🎛️ <b>Output Format:</b> choose JPEG or WEBP with /format.\n"
+        "📐 <b>Sizes:</b> pick one or more presets with /presets or name them in the caption.\n"
         "❌ <b>Ignored:</b> Videos and hidden files (starting with a dot).\n"
         "📦 <b>Maximum Archive Size:</b> <b>20 MB</b>.\n\n"
         "🔗 <b>Source Code:</b> https://github.com/akadorkin/image-resizer-bot"
@@ -78,11 +101,8 @@ async def start(update: Update, context):
 # **Archive Handling**
 async def handle_archive(update: Update, context):
     user_id = update.message.from_user.id
-    if user_id not in stats["users"]:
-        stats["users"].append(user_id)
-        save_stats(stats)
-    stats["archives"] += 1
-    save_stats(stats)
+    stats.add_user(user_id)
+    stats.incr("archives")
 
     file = update.message.document
     file_name = file.file_name.lower()
@@ -97,70 +117,112 @@ async def handle_archive(update: Update, context):
         await update.message.reply_text("❌ File size exceeds the 20 MB limit.")
         return
 
-    temp_folder = os.path.join(TEMP_DIR, str(uuid.uuid4()))
-    os.makedirs(temp_folder, exist_ok=True)
-
-    archive_path = os.path.join(temp_folder, file.file_name)
-
+    timer = StageTimer("handle_archive")
+    temp_folder = None
     try:
-        telegram_file = await file.get_file()
-        await telegram_file.download_to_drive(archive_path)
-        logger.info(f"Downloaded archive: {archive_path}")
+        if WORKER_DOWNLOADS:
+            # **Only Pass the file_id; the Worker Downloads the Archive Itself**
+            archive = {"file_id": file.file_id, "file_name": file.file_name, "file_size": file.file_size}
+        else:
+            # **Wait for Room on the Temp Volume without Blocking Other Updates**
+            await asyncio.to_thread(temp_store.wait_for_space, file.file_size, TEMP_WAIT_TIMEOUT)
+            temp_folder = os.path.join(TEMP_DIR, str(uuid.uuid4()))
+            os.makedirs(temp_folder, exist_ok=True)
+            archive = os.path.join(temp_folder, file.file_name)
+
+            with timer.stage("download"):
+                telegram_file = await file.get_file()
+                await telegram_file.download_to_drive(archive)
+            timer.add_bytes("download", file.file_size)
+            logger.info(f"Downloaded archive: {archive}")
 
         # **Notify User Processing Started**
-        await update.message.reply_text("📦 Archive received for processing...")
+        # The worker edits this message to report progress
+        status_message = await update.message.reply_text("📦 Archive received for processing...")
 
         # **Trigger Celery Task**
-        task = process_archive_task.delay(archive_path, FINAL_WIDTH, FINAL_HEIGHT, ASPECT_RATIO_TOLERANCE)
+        # The worker sends the resized archive back itself and removes the temporary folder,
+        # so the handler returns immediately instead of blocking the event loop on the result.
+        # Jobs beyond the user's in-flight limit are parked and dispatched when earlier ones finish.
+        with timer.stage("enqueue"):
+            width, height, presets = output_sizes(user_id, update.message.caption)
+            task = admission.submit(process_archive_task, "archives", user_id, [
+                update.message.chat_id, archive, width, height, ASPECT_RATIO_TOLERANCE,
+                prefs.get(user_id, "encoder_profile"), status_message.message_id, presets
+            ])
+        if task is None:
+            await update.message.reply_text("⏳ Your previous archive is still being processed, this one is queued.")
+            logger.info(f"Archive of user {user_id} queued behind earlier jobs")
+            timer.log(queued=True)
+            return
         logger.info(f"Celery task started: {task.id}")
-
-        # **Wait for Task Completion**
-        result = task.get(timeout=300)  # Timeout after 5 minutes
-
-        success = result.get("success", 0)
-        errors = result.get("errors", 0)
-        elapsed_time = result.get("time", 0)
-        processed_archive_path = result.get("processed_archive", None)
-
-        if processed_archive_path and os.path.exists(processed_archive_path):
-            # **Send Processed Archive Back to User**
-            await update.message.reply_document(
-                document=open(processed_archive_path, "rb"),
-                filename=os.path.basename(processed_archive_path),
-                caption=(
-                    f"✅ <b>Processing Complete.</b>\n"
-                    f"⏱️ <b>Execution Time:</b> {elapsed_time:.2f} seconds\n"
-                    f"🖼️ <b>Images Resized:</b> {success}\n"
-                    f"❌ <b>Images Skipped:</b> {errors}"
-                ),
-                parse_mode="HTML"
-            )
-            logger.info(f"Sent processed archive: {processed_archive_path}")
-        else:
-            await update.message.reply_text(
-                f"❌ Processing completed, but the archive was not created. Images processed: {success}. Images skipped: {errors}."
-            )
+        timer.log(task_id=task.id)
+    except TempStoreFullError as e:
+        logger.warning(f"Archive of user {user_id} refused: {e}")
+        await update.message.reply_text("⏳ The server is busy right now, please send the archive again later.")
     except Exception as e:
         logger.error(f"Error processing archive: {e}")
         await update.message.reply_text(f"❌ An error occurred while processing the archive: {e}")
-    finally:
-        # **Clean Up Temporary Folder**
-        if os.path.exists(temp_folder):
+        # **Clean Up Temporary Folder if the Task Was Not Queued**
+        if temp_folder and os.path.exists(temp_folder):
             shutil.rmtree(temp_folder)
             logger.info(f"Temporary folder {temp_folder} deleted.")
 
+# **Function to Submit a Collected Album after the Debounce Window**
+# Every process that received a photo of the album waits here; only the one that claims it submits.
+async def flush_album(media_group_id):
+    try:
+        delay = ALBUM_DEBOUNCE
+        while delay is not None:
+            await asyncio.sleep(delay)
+            album, delay = albums.claim(media_group_id)
+    except Exception as e:
+        logger.error(f"Error claiming album {media_group_id}: {e}")
+        return
+    finally:
+        album_flushes.pop(media_group_id, None)
+    if album is None:
+        return  # Claimed by another process
+
+    if not album["images"]:
+        shutil.rmtree(album["folder"], ignore_errors=True)
+        return
+    user_id = album["user_id"]
+    try:
+        width, height, presets = output_sizes(user_id, album["caption"])
+        task = admission.submit(process_images_task, "images", user_id, [
+            user_id, album["images"], width, height, ASPECT_RATIO_TOLERANCE,
+            prefs.get(user_id, "encoder_profile"), True, presets
+        ])
+        logger.info(
+            f"Album {media_group_id} with {len(album['images'])} images submitted: {task.id if task else 'queued'}"
+        )
+    except Exception as e:
+        logger.error(f"Error submitting album {media_group_id}: {e}")
+
+# **Function to Start Waiting for an Album unless This Process Already Does**
+def schedule_album_flush(media_group_id):
+    if media_group_id not in album_flushes:
+        album_flushes[media_group_id] = asyncio.create_task(flush_album(media_group_id))
+
 # **Image Handling**
 async def handle_images(update: Update, context):
     user_id = update.message.from_user.id
-    if user_id not in stats["users"]:
-        stats["users"].append(user_id)
-        save_stats(stats)
-    stats["images"] += 1
-    save_stats(stats)
-
-    temp_folder = os.path.join(TEMP_DIR, str(uuid.uuid4()))
-    os.makedirs(temp_folder, exist_ok=True)
+    stats.add_user(user_id)  # Images are counted by the worker that processes them
+
+    # **Photos of One Album Share a Folder and Are Submitted as One Batch**
+    media_group_id = update.message.media_group_id
+    if media_group_id:
+        temp_folder = albums.open(
+            media_group_id, user_id, os.path.join(TEMP_DIR, str(uuid.uuid4())), update.message.caption
+        )
+    else:
+        temp_folder = os.path.join(TEMP_DIR, str(uuid.uuid4()))
+    if not WORKER_DOWNLOADS:
+        os.makedirs(temp_folder, exist_ok=True)
 
+    timer = StageTimer("handle_images")
+    submitted = False
     try:
         # **Determine Image Type**
         if update.message.photo:
@@ -178,15 +240,24 @@ async def handle_images(update: Update, context):
         image_paths = []
         for image in images:
             try:
-                file = await image.get_file()
                 # **Use Original Filename if Available**
                 if hasattr(image, 'file_name') and image.file_name:
                     file_name = image.file_name
                 else:
                     # **Generate Unique Name for Photos without Filename**
                     file_name = f"photo_{uuid.uuid4()}.jpg"
+
+                if WORKER_DOWNLOADS:
+                    # **Only Pass the file_id; the Worker Downloads the Image Itself**
+                    image_paths.append({"file_id": image.file_id, "file_name": file_name, "file_size": image.file_size})
+                    continue
+
+                await asyncio.to_thread(temp_store.wait_for_space, image.file_size or 0, TEMP_WAIT_TIMEOUT)
+                file = await image.get_file()
                 file_path = os.path.join(temp_folder, file_name)
-                await file.download_to_drive(file_path)
+                with timer.stage("download"):
+                    await file.download_to_drive(file_path)
+                timer.add_bytes("download", os.path.getsize(file_path))
                 logger.info(f"Downloaded image: {file_path}")
                 image_paths.append(file_path)
             except Exception as e:
@@ -197,30 +268,108 @@ async def handle_images(update: Update, context):
             await update.message.reply_text("❌ No images available for processing.")
             return
 
+        if media_group_id:
+            albums.add(media_group_id, image_paths)
+            timer.log(media_group_id=media_group_id)
+            return
+
         # **Trigger Celery Task for Images**
-        task = process_images_task.delay(user_id, image_paths, FINAL_WIDTH, FINAL_HEIGHT, ASPECT_RATIO_TOLERANCE)
-        logger.info(f"Celery task started: {task.id}")
+        with timer.stage("enqueue"):
+            width, height, presets = output_sizes(user_id, update.message.caption)
+            task = admission.submit(process_images_task, "images", user_id, [
+                user_id, image_paths, width, height, ASPECT_RATIO_TOLERANCE,
+                prefs.get(user_id, "encoder_profile"), False, presets
+            ])
+        submitted = True
+        logger.info(f"Celery task submitted: {task.id if task else 'queued behind earlier jobs'}")
+        timer.log(task_id=task.id if task else None)
 
         # **No Immediate Notification Required**
         # Processing is handled asynchronously; responses are sent after processing
     except Exception as e:
         logger.error(f"Error handling images: {e}")
         await update.message.reply_text(f"❌ An error occurred while handling images: {e}")
+    finally:
+        if media_group_id:
+            albums.close(media_group_id)
+            schedule_album_flush(media_group_id)
+        elif not submitted:
+            # **Remove the Folder of a Message that Never Reached a Worker**
+            temp_store.remove(temp_folder)
     # **Temporary Folder Cleanup is Handled in Celery Task**
 
+# **Output Format Command Handler**
+async def format_command(update: Update, context):
+    user_id = update.message.from_user.id
+    if not context.args:
+        current = prefs.get(user_id, "encoder_profile", "default")
+        await update.message.reply_text(
+            f"🎛️ <b>Current Output Format:</b> {current}\n"
+            f"<b>Available Profiles:</b> {', '.join(ENCODER_PROFILES)}\n"
+            f"Usage: <code>/format webp</code>, <code>/format jpeg:quality=85,max_bytes=300000</code> "
+            f"or <code>/format default</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    spec = "".join(context.args)
+    if spec == "default":
+        prefs.delete(user_id, "encoder_profile")
+        await update.message.reply_text("✅ Output format reset to the default.")
+        return
+    try:
+        parse_profile(spec)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    prefs.set(user_id, "encoder_profile", spec)
+    await update.message.reply_text(f"✅ Output format set to {spec}.")
+
+# **Size Presets Command Handler**
+async def presets_command(update: Update, context):
+    user_id = update.message.from_user.id
+    if not context.args:
+        current = prefs.get(user_id, "presets") or "default"
+        available = ", ".join(f"{name} ({width}×{height})" for name, (width, height) in PRESETS.items())
+        await update.message.reply_text(
+            f"📐 <b>Current Presets:</b> {current}\n"
+            f"<b>Available Presets:</b> {available}\n"
+            f"Usage: <code>/presets marketplace thumb</code> or <code>/presets default</code>. "
+            f"Preset names in the caption of an archive or photo apply to that request only.",
+            parse_mode="HTML"
+        )
+        return
+
+    if context.args == ["default"]:
+        prefs.delete(user_id, "presets")
+        await update.message.reply_text(f"✅ Sizes reset to the default {FINAL_WIDTH}×{FINAL_HEIGHT}.")
+        return
+    words = " ".join(context.args).replace(",", " ").split()
+    unknown = [word for word in words if word.lstrip("#").lower() not in PRESETS]
+    names = select_presets(" ".join(words), PRESETS)
+    if unknown or not names:
+        await update.message.reply_text(
+            f"❌ Unknown preset: {', '.join(unknown) or ' '.join(context.args)}. Available: {', '.join(PRESETS)}"
+        )
+        return
+    prefs.set(user_id, "presets", ",".join(names))
+    await update.message.reply_text(f"✅ Presets set to {', '.join(names)}.")
+
 # **Statistics Command Handler**
 async def stats_command(update: Update, context):
+    snapshot = stats.snapshot()
     stats_message = (
         f"📊 <b>Bot Statistics:</b>\n"
-        f"👤 <b>Unique Users:</b> {len(stats['users'])}\n"
-        f"📦 <b>Archives Processed:</b> {stats['archives']}\n"
-        f"🖼️ <b>Images Processed:</b> {stats['images']}\n"
-        f"✂️ <b>Images Resized:</b> {stats['resizes']}\n\n"
+        f"👤 <b>Unique Users:</b> {snapshot['users']}\n"
+        f"📦 <b>Archives Processed:</b> {snapshot['archives']}\n"
+        f"🖼️ <b>Images Processed:</b> {snapshot['images']}\n"
+        f"✂️ <b>Images Resized:</b> {snapshot['resizes']}\n"
+        f"♻️ <b>Cache Hits / Misses:</b> {snapshot['cache_hits']} / {snapshot['cache_misses']}\n\n"
         f"🏆 <b>Top 3 Largest Archives:</b>\n"
     )
 
-    if stats["top_archives"]:
-        for i, archive in enumerate(stats["top_archives"], start=1):
+    if snapshot["top_archives"]:
+        for i, archive in enumerate(snapshot["top_archives"], start=1):
             size_mb = archive["size"] / (1024 * 1024)
             time_seconds = archive["time"]
             stats_message += f"{i}. {archive['filename']} - {size_mb:.2f} MB - ⏱️ {time_seconds:.2f} seconds\n"
@@ -231,7 +380,23 @@ async def stats_command(update: Update, context):
 
 # **Main Function to Run the Bot**
 def main():
-    application = Application.builder().token(TOKEN).build()
+    # **Move Counters from an Old stats.json into the Statistics Store**
+    import_legacy_stats(stats, STATS_FILE)
+
+    # **Expose Bot Metrics**
+    start_metrics_server(BOT_METRICS_PORT)
+
+    # **Reclaim Temp Entries Left by Crashed Bots and Workers**
+    temp_store.start_janitor(TEMP_JANITOR_INTERVAL)
+
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{TELEGRAM_API_BASE}/bot")
+        .base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
 
     # **Add Handlers for Commands and Messages**
     application.add_handler(CommandHandler("start", start))
@@ -248,9 +413,23 @@ def main():
         handle_images
     ))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("format", format_command))
+    application.add_handler(CommandHandler("presets", presets_command))
 
     # **Start the Bot**
-    application.run_polling()
+    # All replicas register the same webhook URL, so setting it again on startup is harmless.
+    # Shared state (statistics, preferences, albums, in-flight jobs) lives in Redis, not in the process.
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,129 @@
+import os
+import hashlib
+import logging
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# **Version of the Resize Output, Part of Every Cache Key**
+# Bump whenever the engine produces different output for the same input and settings, so results
+# cached (and uploaded file_ids recorded) by older code are no longer served.
+OUTPUT_VERSION = 2  # 2: animations stay animated
+
+# **Redis Key for Uploaded File IDs**
+FILE_ID_KEY = "cache:file_id:{}"
+FILE_ID_TTL = 30 * 24 * 3600  # Telegram file_ids stay valid for the bot, keep them for 30 days
+
+
+# **Content-Addressed Cache of Resized Images**
+# Entries are stored on local disk under their key and evicted least-recently-used first
+# once the directory grows past max_bytes. Reading an entry refreshes its mtime.
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes, redis_client=None, stats=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.redis = redis_client
+        self.stats = stats
+        self._lock = threading.Lock()
+        self._size_estimate = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(data, *settings):
+        digest = hashlib.sha256(data)
+        digest.update(repr((OUTPUT_VERSION,) + settings).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _count(self, counter):
+        if self.stats is None:
+            return
+        try:
+            self.stats.incr(counter)
+        except Exception as e:
+            logger.error(f"Error updating cache counter {counter}: {e}")
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # **Mark as Recently Used**
+        except FileNotFoundError:
+            self._count("cache_misses")
+            return None
+        self._count("cache_hits")
+        return data
+
+    def put(self, key, data):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # **Write Atomically so Concurrent Readers Never See Partial Entries**
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size_estimate is not None:
+                self._size_estimate += len(data)
+            if self._size_estimate is None or self._size_estimate > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Several worker processes share the directory, so the real size is rescanned here
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total > self.max_bytes:
+            # **Drop Least Recently Used Entries Down to 90% of the Cap**
+            entries.sort()
+            target = self.max_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+            logger.info(f"Result cache evicted down to {total} bytes")
+        self._size_estimate = total
+
+    def get_file_id(self, key):
+        if self.redis is None:
+            return None
+        try:
+            file_id = self.redis.get(FILE_ID_KEY.format(key))
+        except Exception as e:
+            logger.error(f"Error reading cached file_id: {e}")
+            return None
+        return file_id.decode("utf-8") if file_id else None
+
+    def set_file_id(self, key, file_id):
+        if self.redis is None or not file_id:
+            return
+        try:
+            self.redis.set(FILE_ID_KEY.format(key), file_id, ex=FILE_ID_TTL)
+        except Exception as e:
+            logger.error(f"Error caching file_id: {e}")
@@ -0,0 +1,71 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# **Per-Member Progress of an Archive Job, Kept in Redis under the Celery Task Id**
+# A redelivered or retried task has the same id, so it finds the members finished by earlier
+# attempts: members in parts the user already received and rejected members are skipped, and
+# resized members not yet delivered are taken from the result cache instead of being resized again.
+# Checkpoints are best effort: if Redis is unreachable the job simply runs from the start.
+class ArchiveCheckpoint:
+    KEY = "checkpoint:{}"
+    ATTEMPTS = "__attempts__"
+    TIMESTAMP = "__timestamp__"
+    UPLOADED_PARTS = "__uploaded_parts__"
+
+    def __init__(self, redis_client, task_id, ttl=86400):
+        self.redis = redis_client
+        self.key = self.KEY.format(task_id)
+        self.ttl = ttl  # Checkpoints of abandoned jobs are forgotten after this many seconds, 0 disables them
+
+    def begin(self, timestamp):
+        # Counts the attempt and returns (attempt number, timestamp of the first attempt, uploaded parts, members)
+        if not self.ttl:
+            return 1, timestamp, 0, {}
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.key, self.ATTEMPTS, 1)
+            pipe.hsetnx(self.key, self.TIMESTAMP, timestamp)
+            pipe.expire(self.key, self.ttl)
+            pipe.hgetall(self.key)
+            attempts, _, _, fields = pipe.execute()
+        except Exception as e:
+            logger.error(f"Error loading checkpoint {self.key}: {e}")
+            return 1, timestamp, 0, {}
+
+        fields = {name.decode("utf-8"): value.decode("utf-8") for name, value in fields.items()}
+        timestamp = int(fields.pop(self.TIMESTAMP))
+        uploaded_parts = int(fields.pop(self.UPLOADED_PARTS, 0))
+        fields.pop(self.ATTEMPTS, None)
+        members = {name: json.loads(value) for name, value in fields.items()}
+        if attempts > 1:
+            logger.info(f"Resuming {self.key} (attempt {attempts}): {len(members)} members done, "
+                        f"{uploaded_parts} parts delivered")
+        return attempts, timestamp, uploaded_parts, members
+
+    def mark_member(self, member, status, part=None):
+        # status is "resized" (written into output part `part`) or "skipped"
+        if not self.ttl:
+            return
+        try:
+            self.redis.hset(self.key, member, json.dumps({"status": status, "part": part}))
+        except Exception as e:
+            logger.error(f"Error saving checkpoint of {member}: {e}")
+
+    def mark_part_uploaded(self, part):
+        if not self.ttl:
+            return
+        try:
+            self.redis.hset(self.key, self.UPLOADED_PARTS, part)
+        except Exception as e:
+            logger.error(f"Error saving checkpoint of part {part}: {e}")
+
+    def clear(self):
+        if not self.ttl:
+            return
+        try:
+            self.redis.delete(self.key)
+        except Exception as e:
+            logger.error(f"Error clearing checkpoint {self.key}: {e}")
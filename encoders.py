@@ -0,0 +1,134 @@
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# **Built-in Encoder Profiles**
+ENCODER_PROFILES = {
+    "jpeg": {"format": "JPEG", "quality": 90, "optimize": True, "progressive": True, "subsampling": "4:2:0"},
+    "jpeg-max": {"format": "JPEG", "quality": 100, "optimize": True, "subsampling": "4:4:4"},
+    "webp": {"format": "WEBP", "quality": 85, "method": 4},
+    "webp-lossless": {"format": "WEBP", "lossless": True, "quality": 80, "method": 4},
+}
+DEFAULT_PROFILE = "jpeg"
+
+# **File Extension for Each Output Format**
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "GIF": ".gif"}
+
+# **Lowest Quality Tried when Searching for a Target Size**
+MIN_QUALITY = 30
+
+BOOLEAN_OPTIONS = ("optimize", "progressive", "lossless")
+# **Accepted Range of Each Integer Option, None for No Upper Bound**
+INTEGER_OPTIONS = {"quality": (0, 100), "method": (0, 6), "max_bytes": (1, None)}
+SUBSAMPLING_OPTIONS = ("4:4:4", "4:2:2", "4:2:0")
+
+
+# **Function to Parse a Profile Specification**
+# A specification is a profile name optionally followed by overrides, for example
+# "jpeg", "webp:quality=75" or "jpeg:quality=85,subsampling=4:4:4,max_bytes=300000".
+def parse_profile(spec):
+    spec = (spec or DEFAULT_PROFILE).strip()
+    name, _, overrides = spec.partition(":")
+    name = name.strip().lower()
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile '{name}'. Available: {', '.join(ENCODER_PROFILES)}")
+
+    settings = dict(ENCODER_PROFILES[name])
+    for option in filter(None, (part.strip() for part in overrides.split(","))):
+        key, sep, value = option.partition("=")
+        key = key.strip().lower()
+        value = value.strip()
+        if not sep or not value:
+            raise ValueError(f"Invalid encoder option '{option}'")
+        if key in BOOLEAN_OPTIONS:
+            settings[key] = value.lower() in ("1", "true", "yes", "on")
+        elif key in INTEGER_OPTIONS:
+            low, high = INTEGER_OPTIONS[key]
+            try:
+                number = int(value)
+            except ValueError:
+                raise ValueError(f"Encoder option '{key}' must be a whole number")
+            if number < low or (high is not None and number > high):
+                bounds = f"between {low} and {high}" if high is not None else f"at least {low}"
+                raise ValueError(f"Encoder option '{key}' must be {bounds}")
+            settings[key] = number
+        elif key == "subsampling" and settings["format"] == "JPEG":
+            if value not in SUBSAMPLING_OPTIONS:
+                raise ValueError(f"Encoder option 'subsampling' must be one of {', '.join(SUBSAMPLING_OPTIONS)}")
+            settings[key] = value
+        else:
+            raise ValueError(f"Unsupported encoder option '{key}' for {settings['format']}")
+    return settings
+
+
+# **Function to Get the File Extension Matching the Encoder Settings**
+def output_extension(settings):
+    return FORMAT_EXTENSIONS[settings["format"]]
+
+
+# **Function to Get the File Extension of Encoded Output**
+# Animations come out as GIF under a JPEG profile, so the extension is taken from the data itself.
+def data_extension(data, settings):
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return FORMAT_EXTENSIONS["GIF"]
+    return output_extension(settings)
+
+
+# **Function to Get the Animated Format for the Encoder Settings**
+# WebP profiles keep animations in WebP; JPEG cannot animate, so JPEG profiles fall back to GIF.
+def animation_format(settings):
+    return "WEBP" if settings["format"] == "WEBP" else "GIF"
+
+
+def _save(img, settings, quality=None):
+    options = {key: value for key, value in settings.items() if key not in ("format", "max_bytes")}
+    if quality is not None:
+        options["quality"] = quality
+    buffer = io.BytesIO()
+    img.save(buffer, settings["format"], **options)
+    return buffer.getvalue()
+
+
+# **Function to Encode an Image with the Given Settings**
+# With max_bytes set, the highest quality whose output fits is found by binary search
+# (about log2(quality - MIN_QUALITY) extra encodes); if nothing fits, the smallest output is returned.
+def encode_image(img, settings):
+    data = _save(img, settings)
+    max_bytes = settings.get("max_bytes")
+    if not max_bytes or len(data) <= max_bytes or settings.get("lossless"):
+        return data
+
+    best = None
+    smallest = data
+    low, high = MIN_QUALITY, settings.get("quality", 90) - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _save(img, settings, quality)
+        if len(candidate) <= max_bytes:
+            best = candidate
+            low = quality + 1
+        else:
+            smallest = min(smallest, candidate, key=len)
+            high = quality - 1
+
+    if best is None:
+        logger.info(f"No quality fits within {max_bytes} bytes, using the smallest output")
+    return best or smallest
+
+
+# **Function to Encode an Animation**
+# frames are palette images for GIF, or RGB images for WebP; durations are in
+# milliseconds per frame. loop is the source's loop count, None for animations that play once.
+# max_bytes is not searched for animations, one extra encode of every frame per step is too costly.
+def encode_animation(frames, durations, loop, settings):
+    image_format = animation_format(settings)
+    options = {"save_all": True, "append_images": frames[1:], "duration": durations}
+    if image_format == "WEBP":
+        options.update({key: value for key, value in settings.items() if key in ("quality", "method", "lossless")})
+        options["loop"] = 1 if loop is None else loop
+    elif loop is not None:
+        options["loop"] = loop
+    buffer = io.BytesIO()
+    frames[0].save(buffer, image_format, **options)
+    return buffer.getvalue()
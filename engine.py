@@ -0,0 +1,270 @@
+import os
+import io
+import posixpath
+import logging
+import zipfile
+
+import rarfile
+from PIL import Image, ImageChops, ImageSequence
+
+from encoders import animation_format, encode_animation, encode_image
+from metrics import StageTimer
+
+logger = logging.getLogger(__name__)
+
+# **Resize Engine Shared by the Celery Workers and the Offline CLI**
+# Aspect check, resize, padding and encoding of images and reading of archives. Nothing here
+# depends on Telegram or Celery, so it can be imported without BOT_TOKEN or a broker.
+
+# **Resource Limits for Untrusted Inputs**
+MAX_ARCHIVE_MEMBERS = int(os.getenv("MAX_ARCHIVE_MEMBERS", 2000))  # Images per archive, 0 disables the cap
+MAX_UNCOMPRESSED_BYTES = int(os.getenv("MAX_UNCOMPRESSED_BYTES", 1024 * 1024 * 1024))  # Unpacked image bytes per archive, 0 disables the cap
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 50_000_000))  # Per image, 0 disables the cap
+MAX_ANIMATION_FRAMES = int(os.getenv("MAX_ANIMATION_FRAMES", 200))  # Frames per animated image, 0 disables the cap
+
+# **Let Pillow Refuse Decompression Bombs at the Same Pixel Cap**
+# Pillow warns above MAX_IMAGE_PIXELS and raises above twice that; our own header check fires first.
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS or None
+
+# **Supported Image Extensions**
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+# **Formats whose Extra Frames Are an Animation**
+# Multi-picture JPEGs (MPO) from cameras also have several frames but are still photos.
+ANIMATED_FORMATS = ("GIF", "WEBP", "PNG")
+
+# **When a GIF Frame Gets Its Own Palette**
+# A frame is mapped onto the palette of the frame before it unless more than this share of its
+# pixels would come out further than this from their true colour.
+PALETTE_MAX_ERROR = 32  # Largest difference of any colour channel of a pixel, 0-255
+PALETTE_MAX_MISMATCH = 0.01  # Share of the frame's pixels
+
+# **Error Raised when an Input Exceeds the Resource Budget**
+class ResourceLimitError(ValueError):
+    pass
+
+# **Function to Reject Images above the Pixel Cap from Header Dimensions**
+def check_image_pixels(width, height, label):
+    if MAX_IMAGE_PIXELS and width * height > MAX_IMAGE_PIXELS:
+        raise ResourceLimitError(f"image {label} is {width}x{height}, above the limit of {MAX_IMAGE_PIXELS} pixels")
+
+# **Function to Compute the Size of the Image Inside the Padded Canvas**
+def fit_size(width, height, final_width, final_height):
+    scale = min(final_width / width, final_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+# **Function to Flatten an Image onto a White Background**
+def to_rgb(img):
+    if img.mode == "RGB":
+        return img
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+# **Function to Resize One Image to Several Sizes**
+# sizes is a list of (name, width, height). Returns {name: encoded bytes}, or None if the image
+# does not meet the required aspect ratio.
+def resize_image_variants(source, label, sizes, aspect_ratio_tolerance, encoder, timer=None):
+    timer = timer or StageTimer("resize_image")
+    try:
+        img = Image.open(source)
+    except Image.DecompressionBombError as e:
+        raise ResourceLimitError(str(e))
+    with img:
+        # **Check Pixel Count and Aspect Ratio from Header Dimensions Only**
+        # Image.open reads just the header, so rejected images are never decoded.
+        width, height = img.size
+        check_image_pixels(width, height, os.path.basename(str(label)))
+        aspect_ratio = width / height
+        logger.info(f"Processing image {label} with aspect ratio {aspect_ratio:.2f}")
+
+        if not (1 - aspect_ratio_tolerance <= aspect_ratio <= 1 + aspect_ratio_tolerance):
+            logger.info(f"Image {label} does not meet the required aspect ratio.")
+            return None
+
+        # **Largest Variant First**
+        variants = sorted(
+            ((name, final_width, final_height, fit_size(width, height, final_width, final_height))
+             for name, final_width, final_height in sizes),
+            key=lambda variant: variant[3][0] * variant[3][1], reverse=True
+        )
+
+        if img.format in ANIMATED_FORMATS and getattr(img, "is_animated", False):
+            return resize_animation_variants(img, label, variants, encoder, timer)
+
+        # **Decode Once, Near the Largest Target Size**
+        # JPEG draft mode lets libjpeg decode at 1/2, 1/4 or 1/8 scale while staying above the
+        # target size; other formats are shrunk with a cheap box reduce before the final resample.
+        with timer.stage("decode"):
+            if img.format == "JPEG":
+                img.draft(img.mode, variants[0][3])
+            img.load()
+            if img.mode not in ("RGB", "RGBA", "L", "LA"):
+                img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+
+        # **Cascade Each Smaller Variant from the Previous One**
+        # Only the largest variant is resampled from the full decode, so every extra size is cheap.
+        results = {}
+        current = img
+        for name, final_width, final_height, content_size in variants:
+            with timer.stage("resize"):
+                current = current.resize(content_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+                # **Pad Image with White Background**
+                new_img = Image.new("RGB", (final_width, final_height), "white")
+                offset = ((final_width - content_size[0]) // 2, (final_height - content_size[1]) // 2)
+                new_img.paste(to_rgb(current), offset)
+
+            with timer.stage("encode"):
+                results[name] = encode_image(new_img, encoder)
+        return results
+
+# **Function to Map an Animation Frame onto a Palette**
+# Returns the frame mapped onto the palette image without dithering, or quantized with a palette
+# of its own when that palette does not hold the frame's colours (e.g. after a scene change).
+def quantize_frame(frame, palette):
+    if palette is not None:
+        mapped = frame.quantize(palette=palette, dither=Image.Dither.NONE)
+        red, green, blue = ImageChops.difference(frame, mapped.convert("RGB")).split()
+        error = ImageChops.lighter(ImageChops.lighter(red, green), blue).histogram()
+        if sum(error[PALETTE_MAX_ERROR + 1:]) <= PALETTE_MAX_MISMATCH * frame.width * frame.height:
+            return mapped
+    return frame.quantize(256)
+
+# **Function to Resize Every Frame of an Animated GIF, WebP or PNG to Several Sizes**
+# variants is the sorted list built by resize_image_variants. Source frames are decoded one at a
+# time and cascaded through the variants like still images; only the resized frames the encoder
+# needs are kept. GIF frames reuse the palette of the frame before them while it fits, undithered,
+# so unchanged areas stay identical between frames and Pillow stores only the changed area of each one.
+def resize_animation_variants(img, label, variants, encoder, timer):
+    frame_count = img.n_frames
+    if MAX_ANIMATION_FRAMES and frame_count > MAX_ANIMATION_FRAMES:
+        raise ResourceLimitError(f"animation {label} has {frame_count} frames, the limit is {MAX_ANIMATION_FRAMES}")
+    logger.info(f"Resizing {frame_count} frames of animation {label}")
+
+    to_palette = animation_format(encoder) == "GIF"
+    frames = {name: [] for name, _, _, _ in variants}
+    palettes = {}
+    durations = []
+    loop = img.info.get("loop")
+    for frame in ImageSequence.Iterator(img):
+        with timer.stage("decode"):
+            frame.load()
+            durations.append(frame.info.get("duration", 100))
+            current = frame
+            if current.mode not in ("RGB", "RGBA", "L", "LA"):
+                current = current.convert("RGBA" if "transparency" in current.info else "RGB")
+
+        for name, final_width, final_height, content_size in variants:
+            with timer.stage("resize"):
+                current = current.resize(content_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+                new_frame = Image.new("RGB", (final_width, final_height), "white")
+                offset = ((final_width - content_size[0]) // 2, (final_height - content_size[1]) // 2)
+                new_frame.paste(to_rgb(current), offset)
+
+            if to_palette:
+                with timer.stage("encode"):
+                    new_frame = palettes[name] = quantize_frame(new_frame, palettes.get(name))
+            frames[name].append(new_frame)
+
+    results = {}
+    for name in list(frames):
+        with timer.stage("encode"):
+            results[name] = encode_animation(frames.pop(name), durations, loop, encoder)
+    return results
+
+# **Function to Open ZIP or RAR Archives**
+def open_archive(archive_path):
+    if zipfile.is_zipfile(archive_path):
+        logger.info(f"Archive {archive_path} opened as ZIP.")
+        return zipfile.ZipFile(archive_path, "r")
+    if rarfile.is_rarfile(archive_path):
+        logger.info(f"Archive {archive_path} opened as RAR.")
+        return rarfile.RarFile(archive_path, "r")
+    raise ValueError("Unsupported archive format.")
+
+# **Function to Estimate the Peak Memory of Resizing One Image**
+# Decoded pixels dominate: 4 bytes per pixel at the decode size (JPEG draft mode shrinks it by up to 8x
+# per side), plus the resized content and padded canvas of every variant and the input bytes themselves.
+def estimate_image_memory(data, sizes):
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+            image_format = img.format
+            frame_count = getattr(img, "n_frames", 1)
+    except Exception:
+        return len(data)  # Unreadable or oversized images are rejected before decoding
+    if MAX_IMAGE_PIXELS and width * height > MAX_IMAGE_PIXELS:
+        return len(data)
+    if image_format not in ANIMATED_FORMATS:
+        frame_count = 1
+    elif MAX_ANIMATION_FRAMES and frame_count > MAX_ANIMATION_FRAMES:
+        return len(data)
+    variant_pixels = 0
+    content_width = content_height = 0
+    for _, final_width, final_height in sizes:
+        variant_width, variant_height = fit_size(width, height, final_width, final_height)
+        variant_pixels += variant_width * variant_height + final_width * final_height
+        content_width, content_height = max(content_width, variant_width), max(content_height, variant_height)
+    scale = 1
+    if image_format == "JPEG":
+        while scale < 8 and width // (scale * 2) >= content_width and height // (scale * 2) >= content_height:
+            scale *= 2
+    decoded_pixels = (width // scale) * (height // scale)
+    # Animations also keep every resized frame until the encoder runs
+    held_frames = 3 * (frame_count - 1) * sum(final_width * final_height for _, final_width, final_height in sizes)
+    return len(data) + 4 * (decoded_pixels + variant_pixels) + held_frames
+
+# **Function to Name a Variant Inside a Result Archive**
+# With several presets the variants of each preset go into their own folder.
+def variant_path(preset, file_name):
+    return f"{preset}/{file_name}" if preset else file_name
+
+# **Function to List Image Members of an Archive**
+def iter_image_members(archive):
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        member_path = info.filename
+        file_name = os.path.basename(member_path)
+        if file_name.startswith("._") or "__MACOSX" in member_path:
+            logger.info(f"Ignoring file {member_path}")
+            continue
+        if file_name.lower().endswith(IMAGE_EXTENSIONS):
+            yield info, file_name
+
+# **Function to Turn an Archive Member Name into a Relative Path**
+# Member names come from the archive and may be absolute, carry a drive letter or climb out with
+# "..". Returns a normalised "/"-separated path, or None for names that would leave the archive.
+def safe_member_path(member_name):
+    path = member_name.replace("\\", "/")
+    if len(path) > 1 and path[1] == ":":
+        path = path[2:]  # Drive letter
+    path = posixpath.normpath(path.lstrip("/"))
+    if path in (".", "") or path == ".." or path.startswith("../"):
+        return None
+    return path
+
+# **Function to Check Archive Headers against the Resource Budget**
+# Sizes come from the archive directory, so a zip bomb is rejected before a single member is inflated.
+def check_archive_limits(members):
+    if MAX_ARCHIVE_MEMBERS and len(members) > MAX_ARCHIVE_MEMBERS:
+        raise ResourceLimitError(f"it holds {len(members)} images, the limit is {MAX_ARCHIVE_MEMBERS}")
+    total_size = sum(info.file_size for info, _ in members)
+    if MAX_UNCOMPRESSED_BYTES and total_size > MAX_UNCOMPRESSED_BYTES:
+        raise ResourceLimitError(
+            f"its images unpack to {total_size // (1024 * 1024)} MB, the limit is "
+            f"{MAX_UNCOMPRESSED_BYTES // (1024 * 1024)} MB"
+        )
+    return total_size
+
+# **Function to Read an Archive Member No Larger than Its Header Declares**
+def read_member(archive, info):
+    with archive.open(info) as member:
+        data = member.read(info.file_size + 1)
+    if len(data) > info.file_size:
+        raise ResourceLimitError(f"member {info.filename} is larger than its header declares")
+    return data
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import uuid
+import logging
+import argparse
+import mimetypes
+import threading
+from email import message_from_bytes
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+logger = logging.getLogger(__name__)
+
+# **Fake Telegram Bot API Server**
+# Speaks just enough of the Bot API for bot.py (python-telegram-bot) and the Celery workers:
+# getUpdates serves a scripted stream of photo, document and archive messages, getFile and the
+# file endpoint serve the scripted files, and every send*/edit* call is recorded with a timestamp.
+# Point both sides at it with TELEGRAM_API_BASE=http://HOST:PORT; any bot token is accepted.
+#
+#   python loadtest/fake_bot_api.py --port 8081 --script script.jsonl --record calls.jsonl
+#
+# A script line is {"at": seconds, "kind": "photo" | "document" | "archive", "path": "...",
+# "chat_id": 1001, "caption": "optional"}; `at` is relative to the first getUpdates call.
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake Bot", "username": "fake_resizer_bot"}
+RECORDED_PREFIXES = ("send", "edit")
+
+
+# **State Shared by All Request Threads**
+class FakeBotApi:
+    def __init__(self):
+        self.files = {}  # file_id -> bytes
+        self.updates = []
+        self.calls = []
+        self.submitted = {}  # chat_id -> time the update was made available
+        self.first_poll = threading.Event()
+        self._lock = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+
+    # **Scripted Input**
+    def add_file(self, data):
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = data
+        return file_id
+
+    def submit(self, kind, path, chat_id, caption=None):
+        with open(path, "rb") as f:
+            data = f.read()
+        file_id = self.add_file(data)
+        file_name = os.path.basename(path)
+        message = {
+            "message_id": self._message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load", "last_name": str(chat_id)},
+        }
+        if kind == "photo":
+            message["photo"] = [{
+                "file_id": file_id, "file_unique_id": file_id, "width": 0, "height": 0, "file_size": len(data)
+            }]
+        else:
+            mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+            if file_name.lower().endswith(".rar"):
+                mime_type = "application/x-rar-compressed"
+            message["document"] = {
+                "file_id": file_id, "file_unique_id": file_id, "file_name": file_name,
+                "mime_type": mime_type, "file_size": len(data)
+            }
+        if caption:
+            message["caption"] = caption
+
+        with self._lock:
+            self.updates.append({"update_id": self._next_update_id, "message": message})
+            self._next_update_id += 1
+            self.submitted[chat_id] = time.time()
+            self._lock.notify_all()
+
+    def _message_id(self):
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        return message_id
+
+    # **Bot API Methods**
+    def get_updates(self, params):
+        self.first_poll.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.time() + float(params.get("timeout") or 0)
+        with self._lock:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates and time.time() < deadline:
+                self._lock.wait(deadline - time.time())
+            return self.updates[:limit]
+
+    def reply(self, method, params, uploads):
+        chat_id = params.get("chat_id")
+        self.calls.append({
+            "time": time.time(),
+            "method": method,
+            "chat_id": int(chat_id) if chat_id is not None else None,
+            "text": params.get("text") or params.get("caption"),
+            "bytes": sum(len(data) for data in uploads.values()),
+        })
+        message = {
+            "message_id": int(params.get("message_id") or self._message_id()),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "from": BOT_USER,
+        }
+        if method == "sendMediaGroup":
+            return [
+                dict(message, message_id=self._message_id(), document=self._document())
+                for _ in json.loads(params.get("media") or "[]")
+            ]
+        if method == "sendDocument":
+            message["document"] = self._document()
+        elif params.get("text"):
+            message["text"] = params["text"]
+        return message
+
+    def _document(self):
+        file_id = f"sent-{uuid.uuid4().hex}"
+        return {"file_id": file_id, "file_unique_id": file_id}
+
+    def call(self, method, params, uploads):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self.get_updates(params)
+        if method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in self.files:
+                return None
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]),
+                    "file_path": f"files/{file_id}"}
+        if method.startswith(RECORDED_PREFIXES):
+            return self.reply(method, params, uploads)
+        return True  # deleteWebhook, setMyCommands and other calls without a meaningful result
+
+
+# **Function to Parse Form or Multipart Request Bodies**
+# Returns the plain fields and the uploaded files as {field name: bytes}.
+def parse_body(content_type, body):
+    params = {}
+    uploads = {}
+    if content_type.startswith("multipart/form-data"):
+        message = message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body, policy=HTTP)
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True) or b""
+            if part.get_filename() is not None:
+                uploads[name] = payload
+            else:
+                params[name] = payload.decode("utf-8")
+    elif content_type.startswith("application/json"):
+        params = {key: value if isinstance(value, str) else json.dumps(value)
+                  for key, value in json.loads(body or b"{}").items()}
+    else:
+        params = dict(parse_qsl(body.decode("utf-8")))
+    return params, uploads
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_result(self, result):
+            if result is None:
+                payload = {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+                self._send(400, json.dumps(payload).encode())
+            else:
+                self._send(200, json.dumps({"ok": True, "result": result}).encode())
+
+        def _handle(self, body):
+            path = urlparse(self.path)
+            parts = path.path.strip("/").split("/")
+            # **Downloads: /file/bot<token>/files/<file_id>**
+            if parts[0] == "file" and len(parts) >= 3:
+                data = api.files.get(parts[-1])
+                if data is None:
+                    self._send(404, b"Not Found", "text/plain")
+                else:
+                    self._send(200, data, "application/octet-stream")
+                return
+            # **Methods: /bot<token>/<method>**
+            if len(parts) != 2 or not parts[0].startswith("bot"):
+                self._send(404, b"Not Found", "text/plain")
+                return
+            params, uploads = parse_body(self.headers.get("Content-Type", ""), body)
+            params.update(parse_qsl(path.query))
+            self._send_result(api.call(parts[1], params, uploads))
+
+        def do_GET(self):
+            self._handle(b"")
+
+        def do_POST(self):
+            self._handle(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+    return Handler
+
+
+# **Function to Start the Server in a Background Thread**
+def start_server(api, host="127.0.0.1", port=8081):
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Fake Bot API listening on http://{host}:{server.server_port}")
+    return server
+
+
+# **Function to Load a Script File**
+def load_script(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# **Function to Feed Scripted Messages at Their Offsets**
+# The clock starts when the bot first polls getUpdates, so startup time is not measured.
+def replay(api, script):
+    api.first_poll.wait()
+    start = time.time()
+    for entry in sorted(script, key=lambda entry: entry["at"]):
+        delay = start + entry["at"] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        api.submit(entry["kind"], entry["path"], entry["chat_id"], entry.get("caption"))
+    return start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--script", help="JSON lines file of messages to feed to the bot")
+    parser.add_argument("--record", help="Append recorded send/edit calls to this JSON lines file")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    api = FakeBotApi()
+    server = start_server(api, args.host, args.port)
+    try:
+        if args.script:
+            replay(api, load_script(args.script))
+            logger.info("Script finished, serving until interrupted")
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if args.record:
+            with open(args.record, "a") as f:
+                for call in api.calls:
+                    f.write(json.dumps(call) + "\n")
+            logger.info(f"{len(api.calls)} calls written to {args.record}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import zipfile
+
+from fake_bot_api import FakeBotApi, load_script, replay, start_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from bench import synthetic_image  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# **End-to-End Load Driver**
+# Starts the fake Bot API, waits for the bot to poll it, feeds messages at a fixed rate and
+# measures, per message, the time until the first result and until the last reply reached the
+# user through the bot -> Redis -> worker path. Every message comes from its own chat, so
+# replies can be matched to requests and per-user admission limits do not throttle the test.
+#
+#   python loadtest/load_driver.py --rate 5 --duration 60 --mix photo=4,archive=1 --output run.json
+#
+# then start the bot and the workers with TELEGRAM_API_BASE=http://HOST:PORT.
+
+RESULT_METHODS = ("sendDocument", "sendMediaGroup")
+
+
+# **Function to Parse a Message Mix such as "photo=4,archive=1"**
+def parse_mix(spec):
+    mix = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, weight = entry.partition("=")
+        if kind not in ("photo", "document", "archive"):
+            raise ValueError(f"Unknown message kind '{kind}'")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+# **Function to Generate Input Files and the Message Script**
+# Every message gets freshly generated images so the worker's result cache is not hit.
+def build_script(args, folder):
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    width, height = (int(value) for value in args.image_size.lower().split("x"))
+    script = []
+    for index in range(int(args.rate * args.duration)):
+        kind = rng.choices(list(mix), weights=list(mix.values()))[0]
+        if kind == "archive":
+            path = os.path.join(folder, f"archive_{index:05d}.zip")
+            with zipfile.ZipFile(path, "w") as archive:
+                for image_index in range(args.archive_images):
+                    buffer = io.BytesIO()
+                    synthetic_image(rng, (width, height)).save(buffer, "JPEG", quality=90)
+                    archive.writestr(f"images/image_{image_index:04d}.jpg", buffer.getvalue())
+        else:
+            path = os.path.join(folder, f"{kind}_{index:05d}.jpg")
+            synthetic_image(rng, (width, height)).save(path, "JPEG", quality=90)
+        script.append({"at": round(index / args.rate, 3), "kind": kind, "path": path, "chat_id": 100000 + index})
+    return script
+
+
+# **Function to Wait until Every Chat Got a Result and Replies Stopped Coming**
+def wait_for_results(api, chat_ids, timeout, settle):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        answered = {call["chat_id"] for call in api.calls if is_result(call)}
+        last_call = max((call["time"] for call in api.calls), default=0)
+        if chat_ids <= answered and time.time() - last_call >= settle:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def is_result(call):
+    return call["method"] in RESULT_METHODS or (call["method"] == "sendMessage" and (call["text"] or "").startswith("❌"))
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+    return {
+        "count": len(values), "mean": round(sum(values) / len(values), 3),
+        "p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": round(values[-1], 3),
+    }
+
+
+# **Function to Summarize Latencies and Throughput**
+def summarize(api, script, started):
+    kinds = {entry["chat_id"]: entry["kind"] for entry in script}
+    by_chat = {}
+    for call in api.calls:
+        by_chat.setdefault(call["chat_id"], []).append(call)
+
+    first_result = {kind: [] for kind in set(kinds.values())}
+    complete = {kind: [] for kind in set(kinds.values())}
+    failed = 0
+    finished_at = started
+    for chat_id, kind in kinds.items():
+        calls = by_chat.get(chat_id, [])
+        results = [call for call in calls if is_result(call)]
+        if not results:
+            continue
+        submitted = api.submitted[chat_id]
+        failed += any(call["method"] == "sendMessage" for call in results)
+        first_result[kind].append(results[0]["time"] - submitted)
+        complete[kind].append(calls[-1]["time"] - submitted)
+        finished_at = max(finished_at, calls[-1]["time"])
+
+    completed = sum(len(values) for values in complete.values())
+    elapsed = finished_at - started
+    return {
+        "messages": len(script),
+        "completed": completed,
+        "failed": failed,
+        "unanswered": len(script) - completed,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_sec": round(completed / elapsed, 3) if elapsed > 0 else None,
+        "time_to_first_result": {kind: percentiles(values) for kind, values in first_result.items()},
+        "time_to_complete": {kind: percentiles(values) for kind, values in complete.items()},
+        "uploaded_bytes": sum(call["bytes"] for call in api.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test against the fake Bot API")
+    parser.add_argument("--host", default="127.0.0.1", help="Address the fake Bot API listens on")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rate", type=float, default=2.0, help="Messages per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to send messages for")
+    parser.add_argument("--mix", default="photo=4,archive=1", help="Weights of photo, document and archive messages")
+    parser.add_argument("--image-size", default="2000x2000", help="Size of the generated images")
+    parser.add_argument("--archive-images", type=int, default=20, help="Images per generated archive")
+    parser.add_argument("--script", help="Replay this JSON lines script instead of generating one")
+    parser.add_argument("--seed", default="loadtest")
+    parser.add_argument("--connect-timeout", type=float, default=120, help="Seconds to wait for the bot to poll")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for all results")
+    parser.add_argument("--settle", type=float, default=3, help="Quiet seconds that mark the end of the run")
+    parser.add_argument("--output", help="Write the summary to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    with tempfile.TemporaryDirectory(prefix="resizer-load-") as folder:
+        script = load_script(args.script) if args.script else build_script(args, folder)
+        logger.info(f"Prepared {len(script)} messages")
+
+        api = FakeBotApi()
+        server = start_server(api, args.host, args.port)
+        logger.info(f"Start the bot and workers with TELEGRAM_API_BASE=http://{args.host}:{server.server_port}")
+        if not api.first_poll.wait(args.connect_timeout):
+            logger.error("The bot never polled getUpdates")
+            sys.exit(1)
+
+        started = replay(api, script)
+        logger.info("All messages sent, waiting for results")
+        if not wait_for_results(api, {entry["chat_id"] for entry in script}, args.timeout, args.settle):
+            logger.warning("Timed out before every message was answered")
+        server.shutdown()
+
+    summary = summarize(api, script, started)
+    summary["settings"] = {key: value for key, value in vars(args).items() if key != "output"}
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Histogram, start_http_server
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# **Histogram Buckets**
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KB .. 256 MB
+
+# **Metric Definitions**
+STAGE_SECONDS = Histogram(
+    "resizer_stage_seconds", "Time spent in each processing stage", ["task", "stage"], buckets=SECONDS_BUCKETS
+)
+STAGE_BYTES = Histogram(
+    "resizer_stage_bytes", "Bytes handled by each processing stage", ["task", "stage"], buckets=BYTES_BUCKETS
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "resizer_queue_wait_seconds", "Time between enqueueing a task and the worker starting it", ["task"],
+    buckets=SECONDS_BUCKETS
+)
+
+
+# **Per-Job Stage Timer**
+# Collects the time and bytes of every stage of one job, feeds them into the histograms and
+# logs them as a single JSON line when the job finishes. Safe to use from pool threads.
+class StageTimer:
+    def __init__(self, task):
+        self.task = task
+        self.started = time.perf_counter()
+        self.timings = defaultdict(float)
+        self.byte_counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - stage_start)
+
+    def add_time(self, name, seconds):
+        STAGE_SECONDS.labels(self.task, name).observe(seconds)
+        with self._lock:
+            self.timings[name] += seconds
+
+    def add_bytes(self, name, count):
+        STAGE_BYTES.labels(self.task, name).observe(count)
+        with self._lock:
+            self.byte_counts[name] += count
+
+    def log(self, **extra):
+        record = {
+            "task": self.task,
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "stages": {name: round(seconds, 4) for name, seconds in self.timings.items()},
+            "bytes": dict(self.byte_counts),
+        }
+        record.update(extra)
+        logger.info(f"Stage timings: {json.dumps(record)}")
+
+
+# **Function to Record Queue Wait Time**
+def observe_queue_wait(task, enqueued_at):
+    if enqueued_at:
+        wait = max(0.0, time.time() - float(enqueued_at))
+        QUEUE_WAIT_SECONDS.labels(task).observe(wait)
+        return wait
+    return None
+
+
+# **Function to Start the Prometheus Metrics Endpoint**
+# With PROMETHEUS_MULTIPROC_DIR set (Celery prefork workers), every child process writes its
+# samples to that directory and the endpoint aggregates them; otherwise the default registry is served.
+# Must be called in the parent before any child starts, since stale samples are removed here.
+def start_metrics_server(port):
+    if not port:
+        return
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for file_name in os.listdir(multiproc_dir):
+            if file_name.endswith(".db"):
+                os.remove(os.path.join(multiproc_dir, file_name))
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+    else:
+        start_http_server(port)
+    logger.info(f"Metrics endpoint listening on port {port}")
+
+
+# **Function to Drop Samples of a Finished Worker Process**
+def mark_process_dead(pid):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,34 @@
+import os
+import logging
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+# **Per-User Preferences Stored in a Redis Hash**
+class UserPrefs:
+    KEY = "prefs:{}"
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def get(self, user_id, name, default=None):
+        try:
+            value = self.redis.hget(self.KEY.format(user_id), name)
+        except Exception as e:
+            logger.error(f"Error reading preference {name} for user {user_id}: {e}")
+            return default
+        return value.decode("utf-8") if value is not None else default
+
+    def set(self, user_id, name, value):
+        self.redis.hset(self.KEY.format(user_id), name, value)
+
+    def delete(self, user_id, name):
+        self.redis.hdel(self.KEY.format(user_id), name)
+
+
+# **Function to Create the Preferences Store**
+def create_user_prefs():
+    redis_url = os.getenv("PREFS_REDIS_URL", os.getenv("CELERY_BACKEND_URL", "redis://redis:6379/0"))
+    return UserPrefs(redis.Redis.from_url(redis_url))
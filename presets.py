@@ -0,0 +1,33 @@
+# **Presets Used when PRESETS Is Not Set**
+DEFAULT_PRESETS = "marketplace:900x1200,small:600x800,thumb:300x400"
+
+
+# **Function to Parse a Preset List**
+# A list is comma-separated "name:WIDTHxHEIGHT" entries, for example "marketplace:900x1200,thumb:300x400".
+def parse_presets(spec):
+    presets = {}
+    for entry in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, sep, size = entry.partition(":")
+        name = name.strip().lower()
+        width, x, height = size.strip().lower().partition("x")
+        if not sep or not name or not x or not width.isdigit() or not height.isdigit() \
+                or int(width) == 0 or int(height) == 0:
+            raise ValueError(f"Invalid preset '{entry}', expected name:WIDTHxHEIGHT")
+        presets[name] = (int(width), int(height))
+    return presets
+
+
+# **Function to Pick the Presets Named in a Text**
+# Every word of a caption or command that names a known preset selects it, in order and without duplicates.
+def select_presets(text, presets):
+    names = []
+    for word in (text or "").replace(",", " ").split():
+        name = word.lstrip("#").lower()
+        if name in presets and name not in names:
+            names.append(name)
+    return names
+
+
+# **Function to Build the Variant List Passed to the Celery Tasks**
+def preset_sizes(names, presets):
+    return [[name, *presets[name]] for name in names]
@@ -0,0 +1,257 @@
+import os
+import io
+import sys
+import time
+import uuid
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from encoders import FORMAT_EXTENSIONS, data_extension, output_extension, parse_profile
+from engine import (
+    IMAGE_EXTENSIONS, ResourceLimitError, iter_image_members, open_archive, read_member, resize_image_variants,
+    safe_member_path, variant_path
+)
+from presets import DEFAULT_PRESETS, parse_presets, preset_sizes
+
+logger = logging.getLogger("resize_cli")
+
+# **Offline Batch Resizer**
+# Runs the same resize engine as the workers over local folders, images and ZIP/RAR archives,
+# without Telegram, Celery or Redis. Images are resized in a process pool; outputs that already
+# exist are skipped, so an interrupted run picks up where it stopped.
+#
+#   python resize_cli.py /data/catalog --output /data/resized
+#   python resize_cli.py photos.zip more_photos/ --output out --preset marketplace --preset thumb
+#
+# Output paths mirror the inputs: folder/a/b.jpg -> OUTPUT/a/b.jpg, archive.zip:dir/c.png ->
+# OUTPUT/archive/dir/c.jpg, and with presets each preset gets its own top-level folder. When two
+# images would share an output (a.jpg and a.png, or photos.zip next to a photos/ folder), the later
+# one keeps its source extensions in the path: OUTPUT/a.png.jpg, OUTPUT/photos.zip/x.jpg.jpg.
+
+ARCHIVE_EXTENSIONS = ('.zip', '.rar')
+PROGRESS_EVERY = 100  # Images between progress lines
+
+
+# **Function to Collect the Images of the Given Inputs**
+# Returns a list of (source path, archive member or None, output path without the output extension).
+# Images whose output path another image already takes get the path with source extensions instead;
+# if that is taken too, they are reported and left out. An image reached through two inputs is resized once.
+def collect_jobs(inputs):
+    jobs = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for folder, dirs, files in os.walk(input_path):
+                dirs.sort()
+                for file_name in sorted(files):
+                    path = os.path.join(folder, file_name)
+                    jobs.extend(file_jobs(path, os.path.relpath(path, input_path)))
+        elif os.path.isfile(input_path):
+            jobs.extend(file_jobs(input_path, os.path.basename(input_path)))
+        else:
+            logger.error(f"Input {input_path} does not exist")
+
+    unique = {}
+    sources = set()
+    for path, member, relative_stem, relative_name in jobs:
+        source = (os.path.realpath(path), member)
+        if source in sources:
+            continue  # The same image reached through two inputs
+        sources.add(source)
+        for candidate in (relative_stem, relative_name):
+            key = os.path.normcase(candidate)
+            if key not in unique:
+                unique[key] = (path, member, candidate)
+                break
+        else:
+            logger.error(
+                f"Skipping {job_label(path, member)}, its output {relative_name} is already taken by "
+                f"{job_label(*unique[key][:2])}"
+            )
+    return list(unique.values())
+
+
+# Returns (source path, archive member or None, output path without extensions, output path with the
+# source extensions) for the images of one file.
+def file_jobs(path, relative_path):
+    stem, extension = os.path.splitext(relative_path)
+    extension = extension.lower()
+    if os.path.basename(path).startswith("._"):
+        return []
+    if extension in IMAGE_EXTENSIONS:
+        return [(path, None, stem, relative_path)]
+    if extension in ARCHIVE_EXTENSIONS:
+        try:
+            with open_archive(path) as archive:
+                jobs = []
+                for info, _ in iter_image_members(archive):
+                    member_path = safe_member_path(info.filename)
+                    if member_path is None:
+                        logger.error(f"Skipping {path}:{info.filename}, its path leads outside the archive")
+                        continue
+                    jobs.append((
+                        path, info.filename,
+                        os.path.join(stem, *os.path.splitext(member_path)[0].split("/")),
+                        os.path.join(relative_path, *member_path.split("/"))
+                    ))
+                return jobs
+        except Exception as e:
+            logger.error(f"Error reading archive {path}: {e}")
+    return []
+
+
+def job_label(path, member):
+    return f"{path}:{member}" if member else path
+
+
+# **Function to Check that an Output Path Stays inside the Output Folder**
+def inside_folder(path, folder):
+    folder = os.path.realpath(folder)
+    return os.path.commonpath([os.path.realpath(path), folder]) == folder
+
+
+# **Function to Name the Outputs of One Image, without Extension**
+# The extension follows the encoded data, animations under a JPEG profile come out as GIF.
+def output_paths(output_dir, relative_stem, sizes):
+    return {name: os.path.join(output_dir, variant_path(name, relative_stem)) for name, _, _ in sizes}
+
+
+def output_exists(output_stem, extension):
+    return any(os.path.exists(output_stem + ext) for ext in (extension, FORMAT_EXTENSIONS["GIF"]))
+
+
+# **Open Archives of the Current Pool Process**
+# Kept open between jobs, so members of one archive do not reopen it every time.
+_archives = {}
+
+
+def read_source(path, member):
+    if member is None:
+        with open(path, "rb") as f:
+            return f.read()
+    archive = _archives.get(path)
+    if archive is None:
+        archive = _archives[path] = open_archive(path)
+    return read_member(archive, archive.getinfo(member))
+
+
+# **Function Run in the Pool for One Image**
+# Returns (status, input bytes, output bytes, message); status is "resized", "rejected" or "error".
+def process_job(job, outputs, sizes, aspect_ratio_tolerance, encoder):
+    path, member, _ = job
+    label = job_label(path, member)
+    try:
+        data = read_source(path, member)
+        variants = resize_image_variants(io.BytesIO(data), label, sizes, aspect_ratio_tolerance, encoder)
+        if variants is None:
+            return "rejected", len(data), 0, f"{label} does not meet the required aspect ratio"
+        written = 0
+        for name, resized in variants.items():
+            # **Write Atomically so an Interrupted Run Never Leaves a Partial Output Behind**
+            output_path = outputs[name] + data_extension(resized, encoder)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(resized)
+            os.replace(tmp_path, output_path)
+            written += len(resized)
+        return "resized", len(data), written, None
+    except ResourceLimitError as e:
+        return "rejected", 0, 0, f"{label} rejected: {e}"
+    except Exception as e:
+        return "error", 0, 0, f"Error processing {label}: {e}"
+
+
+# **Function to Configure Logging in the Main and Pool Processes**
+# The engine logs every image at INFO level, which is only wanted with --verbose.
+def configure_logging(verbose):
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not verbose:
+        logging.getLogger("engine").setLevel(logging.WARNING)
+        logging.getLogger("encoders").setLevel(logging.WARNING)
+
+
+# **Function to Resolve the Output Sizes**
+def resolve_sizes(args):
+    if not args.preset:
+        return [[None, args.width, args.height]]
+    presets = parse_presets(args.presets)
+    unknown = [name for name in args.preset if name.lower() not in presets]
+    if unknown:
+        raise ValueError(f"Unknown presets: {', '.join(unknown)}. Available: {', '.join(presets)}")
+    return preset_sizes(list(dict.fromkeys(name.lower() for name in args.preset)), presets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resize local images and archives with the bot's resize engine")
+    parser.add_argument("inputs", nargs="+", help="Folders, images or ZIP/RAR archives")
+    parser.add_argument("--output", required=True, help="Folder for the resized images")
+    parser.add_argument("--width", type=int, default=int(os.getenv("FINAL_WIDTH", 900)))
+    parser.add_argument("--height", type=int, default=int(os.getenv("FINAL_HEIGHT", 1200)))
+    parser.add_argument("--tolerance", type=float, default=float(os.getenv("ASPECT_RATIO_TOLERANCE", 0.15)),
+                        help="Accepted deviation of the source aspect ratio from 1")
+    parser.add_argument("--profile", default=os.getenv("ENCODER_PROFILE", "jpeg"), help="Encoder profile")
+    parser.add_argument("--preset", action="append", help="Produce this named preset size (repeatable)")
+    parser.add_argument("--presets", default=os.getenv("PRESETS", DEFAULT_PRESETS), help="Preset definitions")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Pool processes")
+    parser.add_argument("--force", action="store_true", help="Resize images whose outputs already exist")
+    parser.add_argument("--verbose", action="store_true", help="Log every image")
+    args = parser.parse_args()
+
+    configure_logging(args.verbose)
+    try:
+        encoder = parse_profile(args.profile)
+        sizes = resolve_sizes(args)
+    except ValueError as e:
+        parser.error(str(e))
+    extension = output_extension(encoder)
+
+    # **Skip Images whose Outputs All Exist**
+    jobs = collect_jobs(args.inputs)
+    pending = []
+    existing = 0
+    for job in jobs:
+        outputs = output_paths(args.output, job[2], sizes)
+        if not all(inside_folder(path, args.output) for path in outputs.values()):
+            logger.error(f"Skipping {job_label(*job[:2])}, its output would leave {args.output}")
+        elif args.force or not all(output_exists(path, extension) for path in outputs.values()):
+            pending.append((job, outputs))
+        else:
+            existing += 1
+    logger.info(f"Found {len(jobs)} images, {existing} already done, {len(pending)} to resize "
+                f"with {args.workers} processes")
+
+    counts = {"resized": 0, "rejected": 0, "error": 0}
+    input_bytes = output_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=configure_logging,
+                             initargs=(args.verbose,)) as executor:
+        futures = [
+            executor.submit(process_job, job, outputs, sizes, args.tolerance, encoder)
+            for job, outputs in pending
+        ]
+        for done, future in enumerate(as_completed(futures), 1):
+            status, read, written, message = future.result()
+            counts[status] += 1
+            input_bytes += read
+            output_bytes += written
+            if message:
+                (logger.error if status == "error" else logger.warning)(message)
+            if done % PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - start
+                logger.info(f"{done}/{len(pending)} images, {done / elapsed:.1f} images/s")
+
+    # **Report Throughput**
+    elapsed = time.perf_counter() - start
+    rate = len(pending) / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Done in {elapsed:.2f} seconds: {counts['resized']} resized, {existing} already done, "
+        f"{counts['rejected']} rejected, {counts['error']} errors; {rate:.2f} images/s, "
+        f"{input_bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0:.2f} MB/s read, "
+        f"{output_bytes / (1024 * 1024):.1f} MB written"
+    )
+    sys.exit(1 if counts["error"] else 0)
+
+
+if __name__ == "__main__":
+    main()
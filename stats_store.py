@@ -0,0 +1,142 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# **Counters Shown by /stats**
+COUNTERS = ("archives", "images", "resizes", "cache_hits", "cache_misses")
+TOP_ARCHIVES = 3
+
+
+# **Redis Statistics Backend**
+# Counters live in a hash updated with HINCRBY, unique users in a HyperLogLog and the
+# largest archives in a sorted set scored by size, so every update is a single atomic command.
+class RedisStats:
+    COUNTERS_KEY = "stats:counters"
+    USERS_KEY = "stats:users"
+    TOP_ARCHIVES_KEY = "stats:top_archives"
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def incr(self, counter, amount=1):
+        if amount:
+            self.redis.hincrby(self.COUNTERS_KEY, counter, amount)
+
+    def add_user(self, user_id):
+        self.redis.pfadd(self.USERS_KEY, user_id)
+
+    def record_archive(self, filename, size, elapsed_time):
+        member = json.dumps({"filename": filename, "size": size, "time": elapsed_time}, ensure_ascii=False)
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.TOP_ARCHIVES_KEY, {member: size})
+        pipe.zremrangebyrank(self.TOP_ARCHIVES_KEY, 0, -(TOP_ARCHIVES + 1))
+        pipe.execute()
+
+    def snapshot(self):
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.COUNTERS_KEY)
+        pipe.pfcount(self.USERS_KEY)
+        pipe.zrevrange(self.TOP_ARCHIVES_KEY, 0, TOP_ARCHIVES - 1)
+        counters, users, top_archives = pipe.execute()
+
+        snapshot = {name: int(counters.get(name.encode("utf-8"), 0)) for name in COUNTERS}
+        snapshot["users"] = users
+        snapshot["top_archives"] = [json.loads(member) for member in top_archives]
+        return snapshot
+
+    def is_empty(self):
+        return not self.redis.exists(self.COUNTERS_KEY, self.USERS_KEY)
+
+
+# **SQLite Statistics Backend (Fallback without Redis)**
+class SQLiteStats:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY)")
+            conn.execute("CREATE TABLE IF NOT EXISTS top_archives (filename TEXT, size INTEGER, time REAL)")
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def incr(self, counter, amount=1):
+        if not amount:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (counter, amount)
+            )
+
+    def add_user(self, user_id):
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+
+    def record_archive(self, filename, size, elapsed_time):
+        with self._connect() as conn:
+            conn.execute("INSERT INTO top_archives (filename, size, time) VALUES (?, ?, ?)", (filename, size, elapsed_time))
+            conn.execute(
+                "DELETE FROM top_archives WHERE rowid NOT IN "
+                "(SELECT rowid FROM top_archives ORDER BY size DESC LIMIT ?)",
+                (TOP_ARCHIVES,)
+            )
+
+    def snapshot(self):
+        conn = self._connect()
+        counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        snapshot = {name: counters.get(name, 0) for name in COUNTERS}
+        snapshot["users"] = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        snapshot["top_archives"] = [
+            {"filename": filename, "size": size, "time": elapsed_time}
+            for filename, size, elapsed_time in conn.execute(
+                "SELECT filename, size, time FROM top_archives ORDER BY size DESC LIMIT ?", (TOP_ARCHIVES,)
+            )
+        ]
+        return snapshot
+
+    def is_empty(self):
+        conn = self._connect()
+        return not conn.execute("SELECT 1 FROM counters UNION ALL SELECT 1 FROM users LIMIT 1").fetchone()
+
+
+# **Function to Create the Configured Statistics Backend**
+def create_stats_store():
+    backend = os.getenv("STATS_BACKEND", "redis")
+    if backend == "sqlite":
+        db_path = os.getenv("STATS_DB", "/app/stats/stats.db")
+        logger.info(f"Using SQLite statistics backend: {db_path}")
+        return SQLiteStats(db_path)
+    redis_url = os.getenv("STATS_REDIS_URL", os.getenv("CELERY_BACKEND_URL", "redis://redis:6379/0"))
+    logger.info("Using Redis statistics backend")
+    return RedisStats(redis.Redis.from_url(redis_url))
+
+
+# **Function to Import a Legacy stats.json into an Empty Backend**
+def import_legacy_stats(stats, stats_file):
+    if not os.path.exists(stats_file) or not stats.is_empty():
+        return
+    with open(stats_file, "r", encoding="utf-8") as f:
+        legacy = json.load(f)
+    for name in ("archives", "images", "resizes"):
+        stats.incr(name, legacy.get(name, 0))
+    for user_id in legacy.get("users", []):
+        stats.add_user(user_id)
+    for archive in legacy.get("top_archives", []):
+        stats.record_archive(archive["filename"], archive["size"], archive["time"])
+    os.replace(stats_file, stats_file + ".migrated")
+    logger.info(f"Imported legacy statistics from {stats_file}")
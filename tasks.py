@@ -1,15 +1,31 @@
 import os
+import io
 from pathlib import Path
-from PIL import Image, ImageOps
 from celery import Celery
+from celery.signals import before_task_publish, task_postrun, task_prerun, worker_init, worker_process_shutdown
 import logging
 import zipfile
 import rarfile
 import time
 import shutil
-import requests
-import json
-from filelock import FileLock
+import uuid
+import posixpath
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import redis
+
+from admission import AdmissionControl
+from cache import ResultCache
+from checkpoint import ArchiveCheckpoint
+from stats_store import create_stats_store
+from telegram_client import RedisRateLimiter, TelegramClient
+from temp_store import TempStore
+from encoders import data_extension, output_extension, parse_profile
+from engine import (
+    ResourceLimitError, check_archive_limits, estimate_image_memory, iter_image_members, open_archive,
+    read_member, resize_image_variants, safe_member_path, variant_path
+)
+from metrics import StageTimer, mark_process_dead, observe_queue_wait, start_metrics_server
 
 # **Logging Configuration**
 logging.basicConfig(
@@ -22,6 +38,34 @@ logger = logging.getLogger(__name__)
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
 CELERY_BACKEND_URL = os.getenv("CELERY_BACKEND_URL", "redis://redis:6379/0")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+ARCHIVE_WORKERS = int(os.getenv("ARCHIVE_WORKERS", os.cpu_count() or 1))
+CACHE_DIR = os.getenv("CACHE_DIR", "/app/cache")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 512 * 1024 * 1024))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", 1))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 0))
+TEMP_DIR = os.getenv("TEMP_DIR", "/app/temp")
+TEMP_QUOTA_BYTES = int(os.getenv("TEMP_QUOTA_BYTES", -1))  # Files on the temp volume, -1 derives it from the free space, 0 disables the quota
+TEMP_SPOOL_BYTES = int(os.getenv("TEMP_SPOOL_BYTES", 8 * 1024 * 1024))  # Downloads kept in memory up to this size
+TEMP_MAX_AGE = int(os.getenv("TEMP_MAX_AGE", 6 * 3600))  # Seconds before untouched temp entries are reclaimed, 0 keeps them
+TEMP_JANITOR_INTERVAL = int(os.getenv("TEMP_JANITOR_INTERVAL", 300))  # Seconds between janitor runs
+TEMP_WAIT_TIMEOUT = int(os.getenv("TEMP_WAIT_TIMEOUT", 300))  # Seconds to wait for room under the quota
+IMAGES_QUEUE = os.getenv("IMAGES_QUEUE", "images")
+ARCHIVES_QUEUE = os.getenv("ARCHIVES_QUEUE", "archives")
+MAX_IN_FLIGHT_IMAGES = int(os.getenv("MAX_IN_FLIGHT_IMAGES", 3))  # Per user, 0 disables the cap
+MAX_IN_FLIGHT_ARCHIVES = int(os.getenv("MAX_IN_FLIGHT_ARCHIVES", 1))  # Per user, 0 disables the cap
+ALBUM_ZIP_THRESHOLD = int(os.getenv("ALBUM_ZIP_THRESHOLD", 10))  # Larger batches are sent as one zip
+TASK_MEMORY_BUDGET = int(os.getenv("TASK_MEMORY_BUDGET", 768 * 1024 * 1024))  # Decoded images in flight per task
+PART_MAX_BYTES = int(os.getenv("PART_MAX_BYTES", 45 * 1024 * 1024))  # Output archive part size, 0 sends one archive
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 3))  # Seconds between edits of the status message
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+ARCHIVE_MAX_RETRIES = int(os.getenv("ARCHIVE_MAX_RETRIES", 3))  # Retries of an archive job after transient errors or crashes
+ARCHIVE_RETRY_DELAY = int(os.getenv("ARCHIVE_RETRY_DELAY", 30))  # Seconds before a failed archive job is retried
+CHECKPOINT_TTL = int(os.getenv("CHECKPOINT_TTL", 86400))  # Seconds archive checkpoints are kept, 0 disables them
+BROKER_VISIBILITY_TIMEOUT = int(os.getenv("BROKER_VISIBILITY_TIMEOUT", 3600))  # Seconds before a job of a lost worker is redelivered
+ADMISSION_SLOT_TTL = int(os.getenv("ADMISSION_SLOT_TTL", BROKER_VISIBILITY_TIMEOUT))  # Seconds after which the slot of a crashed job is freed
+ADMISSION_MAX_WAIT = int(os.getenv("ADMISSION_MAX_WAIT", TEMP_MAX_AGE))  # Seconds a job may stay parked, 0 keeps jobs parked
+ADMISSION_REAP_INTERVAL = int(os.getenv("ADMISSION_REAP_INTERVAL", 60))  # Seconds between checks of parked jobs
 
 # **Check for BOT_TOKEN**
 if not BOT_TOKEN:
@@ -31,71 +75,394 @@ if not BOT_TOKEN:
 # **Initialize Celery**
 celery_app = Celery("tasks", broker=CELERY_BROKER_URL, backend=CELERY_BACKEND_URL)
 
-# **Telegram API URL**
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
-
-# **Directories and Files Paths**
-STATS_DIR = "/app/stats"
-STATS_FILE = os.path.join(STATS_DIR, "stats.json")
-STATS_LOCK_FILE = STATS_FILE + ".lock"
-
-# **Statistics Management with File Locking**
-def load_stats():
-    lock = FileLock(STATS_LOCK_FILE)
-    with lock:
-        if not os.path.exists(STATS_FILE):
-            stats = {
-                "users": [],
-                "archives": 0,
-                "images": 0,
-                "resizes": 0,
-                "top_archives": []
-            }
-            save_stats(stats)
-        else:
-            with open(STATS_FILE, "r", encoding="utf-8") as f:
-                stats = json.load(f)
-    return stats
+# **Route Interactive Images and Bulk Archives to Separate Queues**
+# Each queue is consumed by its own worker pool, so archives can never starve single images.
+celery_app.conf.task_routes = {
+    "tasks.process_images_task": {"queue": IMAGES_QUEUE},
+    "tasks.process_archive_task": {"queue": ARCHIVES_QUEUE},
+}
+celery_app.conf.worker_prefetch_multiplier = 1
+
+# **Redeliver Jobs of Workers that Died Mid-Task**
+# Archive jobs are acknowledged only when they finish, so a job whose worker was killed stays in
+# the broker and goes to another worker once the visibility timeout passes. Keep the timeout above
+# the longest archive job, or a job still running is handed out a second time.
+celery_app.conf.broker_transport_options = {"visibility_timeout": BROKER_VISIBILITY_TIMEOUT}
+
+# **Stamp Tasks with Their Enqueue Time to Measure Queue Wait**
+@before_task_publish.connect
+def add_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers["enqueued_at"] = time.time()
+
+# **Function to Read a Custom Message Header from a Task Request**
+def request_header(request, name):
+    value = getattr(request, name, None)
+    if value is None:
+        value = (getattr(request, "headers", None) or {}).get(name)
+    return value
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    wait = observe_queue_wait(task.name, request_header(task.request, "enqueued_at"))
+    if wait is not None:
+        logger.info(f"Task {task.name} waited {wait:.2f} seconds in the queue")
+    admission_key = request_header(task.request, "admission")
+    if admission_key:
+        try:
+            admission.touch(*admission_key)
+        except Exception as e:
+            logger.error(f"Error refreshing admission slot {admission_key}: {e}")
 
-def save_stats(stats):
-    lock = FileLock(STATS_LOCK_FILE)
-    with lock:
-        with open(STATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(stats, f, ensure_ascii=False, indent=4)
+# **Free the User's Admission Slot when a Job Finishes**
+@task_postrun.connect
+def release_admission_slot(task=None, state=None, **kwargs):
+    admission_key = request_header(task.request, "admission")
+    if admission_key and state != "RETRY":
+        try:
+            admission.release(*admission_key)
+        except Exception as e:
+            logger.error(f"Error releasing admission slot {admission_key}: {e}")
+
+# **Expose Worker Metrics**
+@worker_init.connect
+def start_worker_metrics(**kwargs):
+    start_metrics_server(WORKER_METRICS_PORT)
+
+# **Reclaim Temp Entries Left by Crashed Jobs from the Worker's Main Process**
+@worker_init.connect
+def start_temp_janitor(**kwargs):
+    temp_store.start_janitor(TEMP_JANITOR_INTERVAL)
+
+# **Admit Parked Jobs into Slots Freed by Crashed Jobs and Drop Jobs Parked for Too Long**
+@worker_init.connect
+def start_admission_reaper(**kwargs):
+    admission.start_reaper(ADMISSION_REAP_INTERVAL)
+
+@worker_process_shutdown.connect
+def forget_worker_process(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
+
+# **Initialize Redis Client, Statistics Store, Result Cache and Temp Store**
+redis_client = redis.Redis.from_url(CELERY_BACKEND_URL)
+temp_store = TempStore(TEMP_DIR, TEMP_QUOTA_BYTES, TEMP_SPOOL_BYTES, TEMP_MAX_AGE)
+stats = create_stats_store()
+result_cache = ResultCache(CACHE_DIR, CACHE_MAX_BYTES, redis_client, stats)
+
+# **Default Encoder Profile**
+ENCODER_PROFILE = os.getenv("ENCODER_PROFILE", "jpeg")
+parse_profile(ENCODER_PROFILE)  # Fail fast on a misconfigured profile
+
+# **Function to Resolve a User's Encoder Profile**
+# Profiles saved before their options were validated may no longer parse; they fall back to the default.
+def resolve_encoder(encoder_profile):
+    try:
+        return parse_profile(encoder_profile or ENCODER_PROFILE)
+    except ValueError as e:
+        logger.warning(f"Invalid saved encoder profile {encoder_profile}, using {ENCODER_PROFILE}: {e}")
+        return parse_profile(ENCODER_PROFILE)
+
+# **Telegram API URL and Shared Client**
+# One pooled client per worker process keeps connections alive. Sends of all worker processes
+# are paced together through Redis, so bursts of results wait for their turn instead of being
+# dropped on 429.
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}"
+bot_api = TelegramClient(
+    TELEGRAM_API_URL,
+    file_url=f"{TELEGRAM_API_BASE}/file/bot{BOT_TOKEN}",
+    limiter=RedisRateLimiter(redis_client, TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_RATE)
+)
 
 # **Function to Send Messages**
 def send_message(chat_id, text):
-    url = f"{TELEGRAM_API_URL}/sendMessage"
-    data = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
     try:
-        response = requests.post(url, data=data)
-        if not response.ok:
-            logger.error(f"Failed to send message: {response.text}")
+        bot_api.send_message(chat_id, text)
     except Exception as e:
         logger.error(f"Error sending message: {e}")
 
+# **Per-User Admission Control**
+# Parked jobs that waited longer than ADMISSION_MAX_WAIT are dropped; their temp files are left to
+# the temp janitor, and the user is told to send them again.
+def report_dropped_job(job):
+    kind = "archive" if job["kind"] == "archives" else "images"
+    send_message(job["args"][0], f"❌ Your queued {kind} waited too long and was dropped. Please send it again.")
+
+admission = AdmissionControl(
+    redis_client, celery_app, {"images": MAX_IN_FLIGHT_IMAGES, "archives": MAX_IN_FLIGHT_ARCHIVES},
+    ttl=ADMISSION_SLOT_TTL, max_wait=ADMISSION_MAX_WAIT, on_dropped=report_dropped_job
+)
+
 # **Function to Send Documents**
+# Returns the Telegram file_id of the uploaded document so it can be reused later
 def send_document(chat_id, file_path, caption):
-    url = f"{TELEGRAM_API_URL}/sendDocument"
     try:
         with open(file_path, "rb") as f:
-            files = {"document": f}
-            data = {"chat_id": chat_id, "caption": caption, "parse_mode": "HTML"}
-            response = requests.post(url, data=data, files=files)
-            if not response.ok:
-                logger.error(f"Failed to send document: {response.text}")
+            result = bot_api.send_document(chat_id, f, caption)
+        return result["document"]["file_id"]
+    except Exception as e:
+        logger.error(f"Error sending document: {e}")
+    return None
+
+# **Function to Send a Document Held in Memory**
+def send_bytes(chat_id, data, file_name, caption):
+    try:
+        result = bot_api.send_document(chat_id, io.BytesIO(data), caption, filename=file_name)
+        return result["document"]["file_id"]
     except Exception as e:
         logger.error(f"Error sending document: {e}")
+    return None
+
+# **Function to Resend an Already Uploaded Document by file_id**
+def send_cached_document(chat_id, file_id, caption):
+    try:
+        bot_api.send_document(chat_id, file_id, caption)
+        return True
+    except Exception as e:
+        logger.error(f"Error sending cached document: {e}")
+    return False
+
+# **Function to Download a Telegram File Referenced by file_id into a Folder**
+def download_source(source, folder, timer):
+    temp_store.wait_for_space(source.get("file_size") or 0, TEMP_WAIT_TIMEOUT)
+    os.makedirs(folder, exist_ok=True)
+    file_name = os.path.basename(source.get("file_name") or "") or f"file_{uuid.uuid4()}"
+    file_path = os.path.join(folder, file_name)
+    with timer.stage("download"):
+        size = bot_api.download_file(source["file_id"], file_path)
+    timer.add_bytes("download", size)
+    logger.info(f"Downloaded {source['file_id']} to {file_path}")
+    return file_path
+
+# **Function to Resolve Image Inputs**
+# Inputs are paths on the shared temp volume or {"file_id", "file_name", "file_size"} dicts, which
+# are downloaded into spooled files: in memory when small, on the temp volume past TEMP_SPOOL_BYTES.
+# Returns (file name, path or spooled file) pairs and the names of images that could not be downloaded.
+def fetch_images(images, timer):
+    sources = []
+    failed = []
+    for image in images:
+        if isinstance(image, str):
+            sources.append((os.path.basename(image), image))
+            continue
+        file_name = os.path.basename(image.get("file_name") or "") or f"file_{uuid.uuid4()}"
+        spool = None
+        try:
+            file_size = image.get("file_size") or 0
+            if file_size > TEMP_SPOOL_BYTES:
+                temp_store.wait_for_space(file_size, TEMP_WAIT_TIMEOUT)
+            spool = temp_store.spool()
+            with timer.stage("download"):
+                size = bot_api.download_file(image["file_id"], spool)
+            timer.add_bytes("download", size)
+            logger.info(f"Downloaded {image['file_id']} ({size} bytes)")
+            sources.append((file_name, spool))
+        except Exception as e:
+            if spool is not None:
+                spool.close()
+            logger.error(f"Error downloading image {image.get('file_name')}: {e}")
+            failed.append(image.get("file_name") or image["file_id"])
+    return sources, failed
+
+# **Status Message Edited in Place with Throttled Progress**
+# Edits closer together than `interval` seconds are dropped, so a long job costs a handful of
+# API calls instead of one per image. Does nothing when the bot did not pass a message id.
+class ProgressMessage:
+    def __init__(self, chat_id, message_id, interval=PROGRESS_INTERVAL):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.last_update = None
+        self.last_text = None
+
+    def update(self, text, force=False):
+        if self.message_id is None or text == self.last_text:
+            return
+        now = time.monotonic()
+        if not force and self.last_update is not None and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        self.last_text = text
+        try:
+            bot_api.edit_message_text(self.chat_id, self.message_id, text)
+        except Exception as e:
+            logger.warning(f"Error updating progress message: {e}")
+
+# **Output Archive Split into Parts Uploaded while Processing Continues**
+# Each part stays under PART_MAX_BYTES, below the 50 MB Telegram accepts from bots. A full part is
+# handed to a single upload thread, so it travels while later images are still being resized.
+# The last part is left to the caller, which sends it with the final summary.
+# A resumed job starts numbering at first_part; on_uploaded(part) is called for every part
+# delivered while all earlier parts were delivered too.
+class ArchiveParts:
+    ENTRY_OVERHEAD = 30 + 46 + 22  # Local header, central directory record and end of directory record
+
+    def __init__(self, chat_id, folder, timestamp, archive_name, max_bytes, timer, first_part=1, on_uploaded=None):
+        self.chat_id = chat_id
+        self.folder = folder
+        self.timestamp = timestamp
+        self.archive_name = archive_name
+        self.max_bytes = max_bytes
+        self.timer = timer
+        self.on_uploaded = on_uploaded
+        self.upload_failed = False
+        self.part_number = first_part - 1
+        self.part_bytes = 0
+        self.part_path = None
+        self.out_zip = None
+        self.uploads = []
+        self.uploader = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.out_zip is not None:
+            self.out_zip.close()
+            self.out_zip = None
+        self.uploader.shutdown(wait=True)
+
+    @property
+    def parts_sent(self):
+        return sum(1 for upload in self.uploads if upload.done())
+
+    def write(self, file_name, data):
+        entry_bytes = len(data) + 2 * len(file_name.encode("utf-8")) + self.ENTRY_OVERHEAD
+        if self.out_zip is not None and self.max_bytes and self.part_bytes + entry_bytes > self.max_bytes:
+            part_path = self._close_part(last=False)
+            self.uploads.append(self.uploader.submit(self._upload, part_path, self.part_number))
+        if self.out_zip is None:
+            self.part_number += 1
+            self.part_bytes = 0
+            self.part_path = os.path.join(self.folder, f"part_{self.timestamp}_{self.part_number}.tmp")
+            self.out_zip = zipfile.ZipFile(self.part_path, "w")
+        self.out_zip.writestr(file_name, data)
+        self.part_bytes += entry_bytes
+
+    def _close_part(self, last):
+        self.out_zip.close()
+        self.out_zip = None
+        if last and self.part_number == 1:
+            part_name = f"resized_{self.timestamp}_{self.archive_name}"
+        else:
+            stem, _ = os.path.splitext(self.archive_name)
+            part_name = f"resized_{self.timestamp}_{stem}_part{self.part_number}.zip"
+        part_path = os.path.join(self.folder, part_name)
+        os.replace(self.part_path, part_path)
+        self.timer.add_bytes("archive_out", os.path.getsize(part_path))
+        logger.info(f"Resized images archived in {part_path}")
+        return part_path
+
+    def _upload(self, part_path, part_number):
+        with self.timer.stage("upload"):
+            file_id = send_document(self.chat_id, part_path, f"📦 <b>Part {part_number}</b>, more parts follow.")
+        os.remove(part_path)
+        if file_id is None:
+            self.upload_failed = True
+        elif self.on_uploaded and not self.upload_failed:
+            self.on_uploaded(part_number)
+        return file_id is not None
+
+    def finish(self):
+        # Returns the path of the last part (None if nothing was written) and the number of earlier
+        # parts that failed to upload, after all earlier parts have been sent
+        last_path = self._close_part(last=True) if self.out_zip is not None else None
+        self.uploader.shutdown(wait=True)
+        failed = sum(1 for upload in self.uploads if not upload.result())
+        return last_path, failed
+
+# **Function to Deliver Archive Results**
+def deliver_archive_result(chat_id, status):
+    processed_archive_path = status["processed_archive"]
+    if status.get("rejected"):
+        send_message(chat_id, f"❌ Archive rejected: {status['rejected']}.")
+    elif processed_archive_path and os.path.exists(processed_archive_path):
+        caption = (
+            f"✅ <b>Processing Complete.</b>\n"
+            f"⏱️ <b>Execution Time:</b> {status['time']:.2f} seconds\n"
+            f"🖼️ <b>Images Resized:</b> {status['success']}\n"
+            f"❌ <b>Images Skipped:</b> {status['errors']}"
+        )
+        if status.get("parts", 1) > 1:
+            caption += f"\n📦 <b>Parts:</b> {status['parts']}"
+        if status.get("failed_parts"):
+            caption += f"\n⚠️ <b>Parts Not Delivered:</b> {status['failed_parts']}"
+        send_document(chat_id, processed_archive_path, caption)
+        logger.info(f"Sent processed archive {processed_archive_path} to chat {chat_id}")
+    else:
+        send_message(
+            chat_id,
+            f"❌ Processing completed, but the archive was not created. "
+            f"Images processed: {status['success']}. Images skipped: {status['errors']}."
+        )
+
+# **Function to Resize Image Bytes to Several Sizes through the Result Cache**
+# The image is decoded only if at least one variant is missing from the cache.
+def resize_variants_cached(data, label, sizes, aspect_ratio_tolerance, encoder, timer=None, cache_keys=None):
+    timer = timer or StageTimer("resize_image")
+    with timer.stage("cache_lookup"):
+        if cache_keys is None:
+            cache_keys = {name: result_cache.key(data, width, height, encoder) for name, width, height in sizes}
+        variants = {name: result_cache.get(cache_key) for name, cache_key in cache_keys.items()}
+    if all(resized is not None for resized in variants.values()):
+        logger.info(f"Cache hit for image {label}")
+        return variants
+
+    # **Reject Images that Alone Would Exceed the Task Memory Budget**
+    # Long animations hold every resized frame until they are encoded.
+    estimate = estimate_image_memory(data, sizes)
+    if TASK_MEMORY_BUDGET and estimate > TASK_MEMORY_BUDGET:
+        raise ResourceLimitError(
+            f"image {os.path.basename(str(label))} needs about {estimate // (1024 * 1024)} MB to resize, the limit is "
+            f"{TASK_MEMORY_BUDGET // (1024 * 1024)} MB"
+        )
+
+    variants = resize_image_variants(io.BytesIO(data), label, sizes, aspect_ratio_tolerance, encoder, timer)
+    if variants is not None:
+        for name, resized in variants.items():
+            result_cache.put(cache_keys[name], resized)
+    return variants
+
+# **Function to Resize Image Bytes through the Result Cache**
+def resize_image_cached(data, label, final_width, final_height, aspect_ratio_tolerance, encoder,
+                        timer=None, cache_key=None):
+    variants = resize_variants_cached(
+        data, label, [(None, final_width, final_height)], aspect_ratio_tolerance, encoder, timer,
+        cache_keys=None if cache_key is None else {None: cache_key}
+    )
+    return None if variants is None else variants[None]
+
+# **Function to Give Each Result of One Reply Its Own Name**
+# Names already in used (compared without case) get _2, _3, ... appended; the name given is added to used.
+def unique_stem(stem, used):
+    candidate, number = stem, 1
+    while candidate.lower() in used:
+        number += 1
+        candidate = f"{stem}_{number}"
+    used.add(candidate.lower())
+    return candidate
+
+# **Errors that Fail the Same Way on Every Attempt**
+PERMANENT_ARCHIVE_ERRORS = (ValueError, zipfile.BadZipFile, rarfile.Error)
 
 # **Celery Task to Process Archives**
-@celery_app.task
-def process_archive_task(archive_path, final_width, final_height, aspect_ratio_tolerance):
-    stats = load_stats()
+# The job is acknowledged only once it finishes and is redelivered if its worker dies; a retried or
+# redelivered job keeps its task id and resumes from the checkpoint of its earlier attempts.
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def process_archive_task(self, chat_id, archive, final_width, final_height, aspect_ratio_tolerance,
+                         encoder_profile=None, status_message_id=None, presets=None):
+    # archive is a path on the shared temp volume, or {"file_id", "file_name"} to download here;
+    # presets is an optional list of [name, width, height] to produce several sizes in one pass
     start_time = time.time()
-    extracted_folder = os.path.join(os.path.dirname(archive_path), "extracted")
-    processed_folder = os.path.join(os.path.dirname(archive_path), "processed")
-    os.makedirs(extracted_folder, exist_ok=True)
-    os.makedirs(processed_folder, exist_ok=True)
+    timer = StageTimer("process_archive_task")
+    progress = ProgressMessage(chat_id, status_message_id)
+    checkpoint = ArchiveCheckpoint(redis_client, self.request.id, CHECKPOINT_TTL)
+    if isinstance(archive, dict):
+        # Named after the task id, so a retried attempt finds the archive downloaded before
+        temp_folder = os.path.join(TEMP_DIR, f"archive_{self.request.id}")
+        archive_path = os.path.join(temp_folder, os.path.basename(archive.get("file_name") or "archive.zip"))
+    else:
+        archive_path = archive
+        temp_folder = os.path.dirname(archive_path)
 
     success_count = 0
     error_count = 0
@@ -103,87 +470,139 @@ def process_archive_task(archive_path, final_width, final_height, aspect_ratio_t
     archive_size = 0
 
     try:
+        encoder = resolve_encoder(encoder_profile)
+
+        sizes = presets or [[None, final_width, final_height]]
+
+        # **Resume from the Checkpoint of Earlier Attempts**
+        # The first attempt's timestamp keeps output names stable across attempts. A job whose
+        # worker keeps dying (e.g. killed for memory) is given up instead of crashing workers forever.
+        attempts, timestamp, uploaded_parts, done_members = checkpoint.begin(int(time.time()))
+        if attempts > ARCHIVE_MAX_RETRIES + 1:
+            raise ResourceLimitError(f"it could not be processed after {attempts - 1} attempts")
+
+        if isinstance(archive, dict) and not os.path.exists(archive_path):
+            archive_path = download_source(archive, temp_folder, timer)
+
         # **Get Archive Size**
         archive_size = os.path.getsize(archive_path)
+        timer.add_bytes("archive_in", archive_size)
         logger.info(f"Archive size {archive_path}: {archive_size} bytes")
 
-        # **Extract Archive**
-        if zipfile.is_zipfile(archive_path):
-            with zipfile.ZipFile(archive_path, "r") as zf:
-                zf.extractall(extracted_folder)
-            logger.info(f"Archive {archive_path} extracted as ZIP.")
-        elif rarfile.is_rarfile(archive_path):
-            with rarfile.RarFile(archive_path, "r") as rf:
-                rf.extractall(extracted_folder)
-            logger.info(f"Archive {archive_path} extracted as RAR.")
-        else:
-            raise ValueError("Unsupported archive format.")
+        original_archive_name = os.path.basename(archive_path)
+
+        # **Stream Members Straight into the New Archive**
+        # Nothing is extracted to disk: each member is read into memory and handed to the pool,
+        # and results are written to the output parts in archive order as soon as they are ready.
+        # Pillow releases the GIL while decoding, resampling and encoding, so a thread pool keeps
+        # all cores busy without forking from inside the prefork worker child.
+        pending = deque()
+        used_names = set()
+        in_flight_bytes = 0
+
+        def write_next_result(parts):
+            nonlocal success_count, error_count, in_flight_bytes
+            info, output_stem, future, estimate = pending.popleft()
+            try:
+                variants = future.result()
+                if variants is None:
+                    checkpoint.mark_member(info.filename, "skipped")
+                    error_count += 1
+                else:
+                    for preset, resized in variants.items():
+                        with timer.stage("zip"):
+                            resized_name = f"{output_stem}{data_extension(resized, encoder)}"
+                            parts.write(variant_path(preset, resized_name), resized)
+                        timer.add_bytes("image_out", len(resized))
+                    checkpoint.mark_member(info.filename, "resized", parts.part_number)
+                    success_count += 1
+            except Exception as e:
+                logger.error(f"Error processing image {info.filename}: {e}")
+                checkpoint.mark_member(info.filename, "skipped")
+                error_count += 1
+            finally:
+                in_flight_bytes -= estimate
+
+            # **Report Progress on the Status Message**
+            text = f"⏳ <b>Processing:</b> {success_count + error_count}/{total_images_in_archive} images"
+            if parts.parts_sent:
+                text += f", {parts.parts_sent} parts sent"
+            progress.update(text)
+
+        with open_archive(archive_path) as archive, \
+                ArchiveParts(chat_id, temp_folder, timestamp, original_archive_name, PART_MAX_BYTES, timer,
+                             uploaded_parts + 1, checkpoint.mark_part_uploaded) as parts, \
+                ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+            members = list(iter_image_members(archive))
+            uncompressed_size = check_archive_limits(members)
+            total_images_in_archive = len(members)  # **Count as Image Processed**
+            logger.info(f"Archive {archive_path} holds {len(members)} images, {uncompressed_size} bytes unpacked")
+
+            for info, file_name in members:
+                # **Preserve Original Folders and Filename with Prefix**
+                # Named before anything is skipped, so every attempt gives a member the same name.
+                member_path = safe_member_path(info.filename) or file_name
+                folder, base_name = posixpath.split(member_path)
+                output_stem = unique_stem(
+                    posixpath.join(folder, f"resized_{timestamp}_{os.path.splitext(base_name)[0]}"), used_names
+                )
+
+                # **Skip Members Settled by Earlier Attempts**
+                # Members in parts the user already received count as resized; the rest are
+                # resized again, mostly straight from the result cache.
+                done = done_members.get(info.filename)
+                if done and done["status"] == "skipped":
+                    error_count += 1
+                    continue
+                if done and done["part"] is not None and done["part"] <= uploaded_parts:
+                    success_count += 1
+                    continue
 
-        # **Process Images**
-        for root, _, files in os.walk(extracted_folder):
-            for file_name in files:
-                if file_name.startswith("._") or "__MACOSX" in root:
-                    logger.info(f"Ignoring file {file_name} in folder {root}")
+                try:
+                    with timer.stage("extract"):
+                        data = read_member(archive, info)
+                    timer.add_bytes("image_in", len(data))
+                except Exception as e:
+                    logger.error(f"Error reading image {info.filename}: {e}")
+                    error_count += 1
                     continue
-                if file_name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif')):
-                    total_images_in_archive += 1  # **Count as Image Processed**
-                    image_path = os.path.join(root, file_name)
-                    try:
-                        with Image.open(image_path) as img:
-                            width, height = img.size
-                            aspect_ratio = width / height
-                            logger.info(f"Processing image {image_path} with aspect ratio {aspect_ratio:.2f}")
-
-                            if not (1 - aspect_ratio_tolerance <= aspect_ratio <= 1 + aspect_ratio_tolerance):
-                                logger.info(f"Image {image_path} does not meet the required aspect ratio.")
-                                error_count += 1
-                                continue
-
-                            # **Resize Image with White Background**
-                            new_img = ImageOps.pad(img, (final_width, final_height), color="white")
-                            timestamp = int(time.time())
-
-                            # **Preserve Original Filename with Prefix**
-                            name, ext = os.path.splitext(file_name)
-                            resized_file_name = f"resized_{timestamp}_{name}{ext}"
-                            resized_file_path = os.path.join(processed_folder, resized_file_name)
-                            new_img.save(resized_file_path, "JPEG", quality=100)
-                            logger.info(f"Saved resized image: {resized_file_path}")
-                            success_count += 1
-                    except Exception as e:
-                        logger.error(f"Error processing image {image_path}: {e}")
-                        error_count += 1
-
-        # **Create New Archive with Resized Images**
-        if success_count > 0:
-            timestamp = int(time.time())
-            original_archive_name = os.path.basename(archive_path)
-            resized_archive_name = f"resized_{timestamp}_{original_archive_name}"
-            processed_archive_path = os.path.join(os.path.dirname(archive_path), resized_archive_name)
-            with zipfile.ZipFile(processed_archive_path, "w") as zf:
-                for root, _, files in os.walk(processed_folder):
-                    for file_name in files:
-                        file_path = os.path.join(root, file_name)
-                        zf.write(file_path, arcname=file_name)
-            logger.info(f"Resized images archived in {processed_archive_path}")
-        else:
-            processed_archive_path = None
+
+                # **Keep the Estimated Memory of Images in Flight within the Task Budget**
+                # The oldest results are written out until this image fits; one image is always let through.
+                estimate = estimate_image_memory(data, sizes)
+                while pending and TASK_MEMORY_BUDGET and in_flight_bytes + estimate > TASK_MEMORY_BUDGET:
+                    write_next_result(parts)
+
+                future = executor.submit(
+                    resize_variants_cached, data, info.filename, sizes, aspect_ratio_tolerance, encoder, timer
+                )
+                pending.append((info, output_stem, future, estimate))
+                in_flight_bytes += estimate
+
+                # **Keep a Bounded Number of Images in Flight**
+                if len(pending) >= ARCHIVE_WORKERS * 2:
+                    write_next_result(parts)
+
+            while pending:
+                write_next_result(parts)
+
+            # **Wait for Earlier Parts so the Summary Arrives Last**
+            processed_archive_path, failed_parts = parts.finish()
+            part_count = parts.part_number
+
+        if processed_archive_path is None:
             logger.info(f"No resized images created for archive {archive_path}")
+        progress.update(f"✅ <b>Processed:</b> {success_count} resized, {error_count} skipped", force=True)
 
         # **Update Statistics**
-        stats["images"] += total_images_in_archive  # **Total Images Processed**
-        stats["resizes"] += success_count  # **Images Resized**
-
+        stats.incr("images", total_images_in_archive)  # **Total Images Processed**
+        stats.incr("resizes", success_count)  # **Images Resized**
         if processed_archive_path and archive_size > 0:
-            stats["top_archives"].append({
-                "filename": os.path.basename(processed_archive_path),
-                "size": archive_size,
-                "time": round(time.time() - start_time, 2)  # Execution time in seconds
-            })
-            # **Sort Top Archives by Size Descending**
-            stats["top_archives"] = sorted(stats["top_archives"], key=lambda x: x["size"], reverse=True)[:3]
-
-        save_stats(stats)
+            stats.record_archive(
+                os.path.basename(processed_archive_path),
+                archive_size,
+                round(time.time() - start_time, 2)  # Execution time in seconds
+            )
 
         # **Execution Time**
         end_time = time.time()
@@ -195,11 +614,23 @@ def process_archive_task(archive_path, final_width, final_height, aspect_ratio_t
             "errors": error_count,
             "time": elapsed_time,
             "processed_archive": processed_archive_path,
-            "archive_size": archive_size
+            "archive_size": archive_size,
+            "parts": part_count,
+            "failed_parts": failed_parts
         }
 
     except Exception as e:
         logger.error(f"Error processing archive {archive_path}: {e}")
+
+        # **Retry Transient Failures, Keeping the Downloaded Archive and the Checkpoint**
+        if not isinstance(e, PERMANENT_ARCHIVE_ERRORS) and self.request.retries < ARCHIVE_MAX_RETRIES:
+            progress.update("⏳ <b>Processing interrupted</b>, retrying shortly...", force=True)
+            options = {}
+            admission_key = request_header(self.request, "admission")
+            if admission_key:
+                options["headers"] = {"admission": admission_key}  # Custom headers are not carried over by retry()
+            raise self.retry(exc=e, countdown=ARCHIVE_RETRY_DELAY, max_retries=ARCHIVE_MAX_RETRIES, **options)
+
         status = {
             "success": 0,
             "errors": 0,
@@ -207,91 +638,234 @@ def process_archive_task(archive_path, final_width, final_height, aspect_ratio_t
             "processed_archive": None,
             "archive_size": 0
         }
+        if isinstance(e, ResourceLimitError):
+            status["rejected"] = str(e)
 
+    try:
+        # **Send Result Back to User**
+        with timer.stage("upload"):
+            deliver_archive_result(chat_id, status)
+        timer.log(success=status["success"], errors=status["errors"])
     finally:
-        # **Clean Up Temporary Files and Folders**
-        if os.path.exists(extracted_folder):
-            shutil.rmtree(extracted_folder)
-            logger.info(f"Temporary folder {extracted_folder} deleted.")
-        if os.path.exists(processed_folder):
-            shutil.rmtree(processed_folder)
-            logger.info(f"Temporary folder {processed_folder} deleted.")
-        if os.path.exists(archive_path):
-            os.remove(archive_path)
-            logger.info(f"Original archive {archive_path} deleted.")
+        checkpoint.clear()
+        # **Clean Up Temporary Folder with Original and Resized Archives**
+        if os.path.exists(temp_folder):
+            shutil.rmtree(temp_folder)
+            logger.info(f"Temporary folder {temp_folder} deleted.")
 
     return status
 
 # **Celery Task to Process Individual Images**
 @celery_app.task
-def process_images_task(user_id, image_paths, final_width, final_height, aspect_ratio_tolerance):
-    stats = load_stats()
-
-    for image_path in image_paths:
-        path = Path(image_path)
-        if not path.exists():
-            logger.error(f"Image {image_path} does not exist.")
-            send_message(user_id, f"❌ Image not found: {path.name}")
-            continue
+def process_images_task(user_id, images, final_width, final_height, aspect_ratio_tolerance,
+                        encoder_profile=None, batch=False, presets=None):
+    timer = StageTimer("process_images_task")
+    encoder = resolve_encoder(encoder_profile)
+    sizes = presets or [[None, final_width, final_height]]
+    sources, failed = fetch_images(images, timer)
+    problems = [f"Error downloading image: {name}" for name in failed]
+    # **Albums and Multi-Preset Requests Get One Combined Reply**
+    if batch or len(sizes) > 1:
+        try:
+            process_image_batch(user_id, sources, sizes, aspect_ratio_tolerance, encoder, timer, problems)
+        finally:
+            remove_images(sources)
+        return
+
+    for problem in problems:
+        send_message(user_id, f"❌ {problem}")
 
+    for file_name, source in sources:
         start_time = time.time()
         try:
-            with Image.open(image_path) as img:
-                width, height = img.size
-                aspect_ratio = width / height
-                logger.info(f"Processing image {image_path} with aspect ratio {aspect_ratio:.2f}")
-
-                # **Count as Image Processed**
-                stats["images"] += 1
-
-                if not (1 - aspect_ratio_tolerance <= aspect_ratio <= 1 + aspect_ratio_tolerance):
-                    logger.info(f"Image {image_path} does not meet the required aspect ratio.")
-                    send_message(
-                        user_id,
-                        f"❌ Image {path.name} does not meet the required aspect ratio."
-                    )
+            with timer.stage("read"):
+                data = read_image(source)
+            timer.add_bytes("image_in", len(data))
+        except FileNotFoundError:
+            logger.error(f"Image {source} does not exist.")
+            send_message(user_id, f"❌ Image not found: {file_name}")
+            continue
+
+        try:
+            cache_key = result_cache.key(data, final_width, final_height, encoder)
+
+            # **Resend Without Re-uploading if This Exact Result Was Delivered Before**
+            file_id = result_cache.get_file_id(cache_key)
+            if file_id:
+                with timer.stage("upload"):
+                    resent = send_cached_document(user_id, file_id, f"✅ Image processed: {file_name}")
+                if resent:
+                    logger.info(f"Resent cached result for image {file_name} to user {user_id}")
+                    stats.incr("images")
+                    stats.incr("resizes")
                     continue
 
-                # **Resize Image with White Background**
-                new_img = ImageOps.pad(img, (final_width, final_height), color="white")
-                timestamp = int(time.time())
+            resized = resize_image_cached(
+                data, file_name, final_width, final_height, aspect_ratio_tolerance, encoder, timer,
+                cache_key=cache_key
+            )
+
+            # **Count as Image Processed**
+            stats.incr("images")
 
-                # **Preserve Original Filename with Prefix**
-                name, ext = os.path.splitext(path.name)
-                if not ext:
-                    ext = '.jpg'  # Set default extension if missing
-                resized_file_name = f"resized_{timestamp}_{name}{ext}"
-                resized_file_path = path.parent / resized_file_name
-                new_img.save(resized_file_path, "JPEG", quality=100)
-                logger.info(f"Saved resized image: {resized_file_path}")
+            if resized is None:
+                send_message(
+                    user_id,
+                    f"❌ Image {file_name} does not meet the required aspect ratio."
+                )
+                continue
+
+            # **Preserve Original Filename with Prefix and the Actual Output Extension**
+            timestamp = int(time.time())
+            name, _ = os.path.splitext(file_name)
+            resized_file_name = f"resized_{timestamp}_{name}{data_extension(resized, encoder)}"
 
             # **Execution Time**
             end_time = time.time()
             elapsed_time = end_time - start_time
             logger.info(f"Image processing time: {elapsed_time:.2f} seconds")
 
-            # **Send Resized Image Back to User**
-            send_document(user_id, str(resized_file_path), f"✅ Image processed: {resized_file_name}\n⏱️ Execution time: {elapsed_time:.2f} seconds")
-            logger.info(f"Sent resized image {resized_file_path} to user {user_id}")
+            # **Send Resized Image Back to User Straight from Memory**
+            timer.add_bytes("image_out", len(resized))
+            with timer.stage("upload"):
+                file_id = send_bytes(user_id, resized, resized_file_name, f"✅ Image processed: {resized_file_name}\n⏱️ Execution time: {elapsed_time:.2f} seconds")
+            result_cache.set_file_id(cache_key, file_id)
+            logger.info(f"Sent resized image {resized_file_name} to user {user_id}")
 
             # **Update Statistics**
-            stats["resizes"] += 1
-            save_stats(stats)
-
-            # **Delete Resized Image from Server**
-            os.remove(resized_file_path)
-            logger.info(f"Temporary resized image {resized_file_path} deleted.")
+            stats.incr("resizes")
 
+        except ResourceLimitError as e:
+            logger.warning(f"Rejected image {file_name}: {e}")
+            send_message(user_id, f"❌ Image rejected: {e}.")
         except Exception as e:
-            logger.error(f"Error processing image {image_path}: {e}")
+            logger.error(f"Error processing image {file_name}: {e}")
             send_message(
                 user_id,
-                f"❌ An error occurred while processing image {path.name}."
+                f"❌ An error occurred while processing image {file_name}."
             )
 
-    # **Delete Original Images from Server**
-    for image_path in image_paths:
-        path = Path(image_path)
+    timer.log(images=len(sources))
+    remove_images(sources)
+
+# **Function to Read an Image Source into Memory**
+def read_image(source):
+    if isinstance(source, str):
+        return Path(source).read_bytes()
+    source.seek(0)
+    return source.read()
+
+# **Function to Delete Original Images from Server**
+# Spooled downloads are closed; files the bot saved on the shared volume are deleted, together with
+# their message folder once it is empty.
+def remove_images(sources):
+    for _, source in sources:
+        if not isinstance(source, str):
+            source.close()
+            continue
+        path = Path(source)
         if path.exists():
             path.unlink()
-            logger.info(f"Original image {image_path} deleted.")
+            logger.info(f"Original image {source} deleted.")
+        if temp_store.remove_if_empty(str(path.parent)):
+            logger.info(f"Temporary folder {path.parent} deleted.")
+
+# **Function to Resize a Batch of Images (One Telegram Album) and Reply Once**
+# sizes is a list of [name, width, height]; with several sizes all variants are packaged in one zip
+def process_image_batch(user_id, sources, sizes, aspect_ratio_tolerance, encoder, timer, problems):
+    results = []  # (resized file name, resized bytes or None when file_id is known, cache key, file_id)
+    resized_count = 0  # Source images with results; with several presets each has several results
+    used_names = set()  # Documents of an album may share a file name
+    timestamp = int(time.time())
+    as_zip = len(sources) > ALBUM_ZIP_THRESHOLD or len(sizes) > 1
+    # A single image with several presets is zipped under its own name, albums as "album"
+    zip_name = os.path.splitext(sources[0][0])[0] if len(sources) == 1 else "album"
+
+    for file_name, source in sources:
+        try:
+            with timer.stage("read"):
+                data = read_image(source)
+            timer.add_bytes("image_in", len(data))
+        except FileNotFoundError:
+            logger.error(f"Image {source} does not exist.")
+            problems.append(f"Image not found: {file_name}")
+            continue
+
+        try:
+            cache_keys = {preset: result_cache.key(data, width, height, encoder) for preset, width, height in sizes}
+            output_stem = unique_stem(f"resized_{timestamp}_{os.path.splitext(file_name)[0]}", used_names)
+
+            # **Count as Image Processed**
+            stats.incr("images")
+
+            # **Reuse an Earlier Upload unless the Batch Goes into a Zip**
+            if not as_zip:
+                cache_key = cache_keys[sizes[0][0]]
+                file_id = result_cache.get_file_id(cache_key)
+                if file_id is not None:
+                    results.append((f"{output_stem}{output_extension(encoder)}", None, cache_key, file_id))
+                    resized_count += 1
+                    continue
+
+            variants = resize_variants_cached(
+                data, file_name, sizes, aspect_ratio_tolerance, encoder, timer, cache_keys=cache_keys
+            )
+            if variants is None:
+                problems.append(f"Image {file_name} does not meet the required aspect ratio.")
+                continue
+            for preset, resized in variants.items():
+                timer.add_bytes("image_out", len(resized))
+                resized_file_name = f"{output_stem}{data_extension(resized, encoder)}"
+                results.append((variant_path(preset, resized_file_name), resized, cache_keys[preset], None))
+            resized_count += 1
+        except ResourceLimitError as e:
+            logger.warning(f"Rejected image {file_name}: {e}")
+            problems.append(f"Image rejected: {e}.")
+        except Exception as e:
+            logger.error(f"Error processing image {file_name}: {e}")
+            problems.append(f"An error occurred while processing image {file_name}.")
+
+    with timer.stage("upload"):
+        deliver_image_batch(user_id, results, resized_count, problems, f"resized_{timestamp}_{zip_name}.zip", as_zip)
+    timer.log(images=len(sources), batch=True)
+
+# **Function to Deliver a Batch of Resized Images**
+# Batches of up to ALBUM_ZIP_THRESHOLD images go back as media groups of at most 10 documents,
+# larger batches as a single zip. Results already uploaded before are resent by file_id.
+# image_count is the number of source images behind the results.
+def deliver_image_batch(chat_id, results, image_count, problems, zip_name, as_zip):
+    if problems:
+        send_message(chat_id, "\n".join(f"❌ {problem}" for problem in problems))
+    if not results:
+        return
+
+    try:
+        if as_zip:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as zf:
+                for file_name, resized, _, _ in results:
+                    zf.writestr(file_name, resized)
+            bot_api.send_document(chat_id, buffer, f"✅ Images processed: {image_count}", filename=zip_name)
+        else:
+            for start in range(0, len(results), 10):
+                chunk = results[start:start + 10]
+                if len(chunk) == 1:
+                    file_name, resized, cache_key, file_id = chunk[0]
+                    result = bot_api.send_document(
+                        chat_id, file_id or io.BytesIO(resized), f"✅ Image processed: {file_name}", filename=file_name
+                    )
+                    result_cache.set_file_id(cache_key, result["document"]["file_id"])
+                    continue
+
+                documents = [
+                    (file_name, file_id or io.BytesIO(resized), None)
+                    for file_name, resized, cache_key, file_id in chunk
+                ]
+                messages = bot_api.send_media_group(chat_id, documents)
+                for (_, _, cache_key, _), message in zip(chunk, messages):
+                    result_cache.set_file_id(cache_key, message["document"]["file_id"])
+        stats.incr("resizes", image_count)
+        logger.info(f"Sent {len(results)} resized files of {image_count} images to chat {chat_id}")
+    except Exception as e:
+        logger.error(f"Error sending resized images: {e}")
+        send_message(chat_id, "❌ An error occurred while sending the resized images.")
@@ -0,0 +1,299 @@
+import os
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+# **Error Returned by the Telegram Bot API**
+class TelegramError(Exception):
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+
+# **Token Bucket Pacing Sends Globally and per Chat**
+# Telegram allows about 30 messages per second overall and about one message per second
+# to the same chat; bursts above that are answered with 429, so sends wait here instead.
+class RateLimiter:
+    def __init__(self, global_rate, per_chat_rate, burst=3):
+        self.global_rate = global_rate
+        self.per_chat_rate = per_chat_rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._global = (float(burst), time.monotonic())
+        self._chats = {}
+
+    @staticmethod
+    def _refill(bucket, rate, burst, now):
+        tokens, updated = bucket
+        return min(burst, tokens + (now - updated) * rate), now
+
+    def acquire(self, chat_id=None):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                global_tokens, _ = self._global = self._refill(self._global, self.global_rate, self.burst, now)
+                wait = 0.0 if global_tokens >= 1 else (1 - global_tokens) / self.global_rate
+
+                chat_tokens = None
+                if chat_id is not None and self.per_chat_rate > 0:
+                    bucket = self._chats.get(chat_id, (float(self.burst), now))
+                    chat_tokens, _ = self._chats[chat_id] = self._refill(bucket, self.per_chat_rate, self.burst, now)
+                    if chat_tokens < 1:
+                        wait = max(wait, (1 - chat_tokens) / self.per_chat_rate)
+
+                if wait == 0.0:
+                    self._global = (global_tokens - 1, now)
+                    if chat_tokens is not None:
+                        self._chats[chat_id] = (chat_tokens - 1, now)
+                    self._forget_idle_chats(now)
+                    return
+            time.sleep(wait)
+
+    def _forget_idle_chats(self, now):
+        # Chats whose bucket has been full for a while carry no state worth keeping
+        if len(self._chats) > 10000:
+            idle_after = self.burst / self.per_chat_rate
+            self._chats = {
+                chat_id: bucket for chat_id, bucket in self._chats.items() if now - bucket[1] < idle_after
+            }
+
+    def penalize(self, chat_id, retry_after):
+        # After a 429 nothing may be sent to that chat until retry_after has passed
+        with self._lock:
+            now = time.monotonic()
+            if chat_id is not None and self.per_chat_rate > 0:
+                self._chats[chat_id] = (-retry_after * self.per_chat_rate, now)
+            else:
+                self._global = (-retry_after * self.global_rate, now)
+
+
+# **Token Buckets Shared through Redis by Every Worker Process**
+# KEYS[1] = global bucket, KEYS[2] = chat bucket (optional); ARGV = now, global rate, chat rate, burst
+# Buckets are hashes of (tokens, updated). Returns "0" once a token was taken from every bucket,
+# otherwise the seconds to wait as a string (Lua numbers are truncated to integers in replies).
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local burst = tonumber(ARGV[4])
+local rates = {tonumber(ARGV[2]), tonumber(ARGV[3])}
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local updated = tonumber(bucket[2]) or now
+    tokens[i] = math.min(burst, (tonumber(bucket[1]) or burst) + math.max(0, now - updated) * rates[i])
+    if tokens[i] < 1 then
+        wait = math.max(wait, (1 - tokens[i]) / rates[i])
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'updated', now)
+    redis.call('EXPIRE', key, math.ceil((burst - tokens[i] + 1) / rates[i]) + 1)
+end
+return '0'
+"""
+
+# **Empty a Bucket for retry_after Seconds after a 429**
+# KEYS[1] = bucket; ARGV = now, rate, retry_after, burst
+PENALIZE_SCRIPT = """
+local rate = tonumber(ARGV[2])
+redis.call('HSET', KEYS[1], 'tokens', -tonumber(ARGV[3]) * rate, 'updated', ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3]) + tonumber(ARGV[4]) / rate) + 1)
+return 1
+"""
+
+
+# **Token Bucket Pacing Sends of All Worker Processes Together**
+# The in-process RateLimiter gives every prefork child its own budget, so N children would send
+# N times the global rate. Here the buckets live in Redis and are taken atomically; if Redis is
+# unreachable, sends fall back to an in-process bucket at the same rates.
+class RedisRateLimiter:
+    GLOBAL_KEY = "telegram:rate:global"
+    CHAT_KEY = "telegram:rate:chat:{}"
+
+    def __init__(self, redis_client, global_rate, per_chat_rate, burst=3):
+        self.global_rate = global_rate
+        self.per_chat_rate = per_chat_rate
+        self.burst = burst
+        self.fallback = RateLimiter(global_rate, per_chat_rate, burst)
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._penalize = redis_client.register_script(PENALIZE_SCRIPT)
+
+    def acquire(self, chat_id=None):
+        keys = [self.GLOBAL_KEY]
+        if chat_id is not None and self.per_chat_rate > 0:
+            keys.append(self.CHAT_KEY.format(chat_id))
+        while True:
+            try:
+                wait = float(self._acquire(
+                    keys=keys, args=[time.time(), self.global_rate, self.per_chat_rate, self.burst]
+                ))
+            except Exception as e:
+                logger.warning(f"Shared rate limit unavailable ({e}), pacing this process only")
+                self.fallback.acquire(chat_id)
+                return
+            if wait == 0.0:
+                return
+            time.sleep(wait)
+
+    def penalize(self, chat_id, retry_after):
+        if chat_id is not None and self.per_chat_rate > 0:
+            key, rate = self.CHAT_KEY.format(chat_id), self.per_chat_rate
+        else:
+            key, rate = self.GLOBAL_KEY, self.global_rate
+        try:
+            self._penalize(keys=[key], args=[time.time(), rate, retry_after, self.burst])
+        except Exception as e:
+            logger.warning(f"Shared rate limit unavailable ({e}), pacing this process only")
+            self.fallback.penalize(chat_id, retry_after)
+
+
+# **Pooled, Rate-Limited Client for the Telegram Bot API**
+# The session is injectable, so calls can be pointed at a stub server or replaced in tests.
+class TelegramClient:
+    def __init__(self, api_url, session=None, timeout=(5, 60), max_retries=5,
+                 global_rate=30.0, per_chat_rate=1.0, pool_size=10, file_url=None, limiter=None):
+        self.api_url = api_url.rstrip("/")
+        self.file_url = (file_url or api_url.replace("/bot", "/file/bot", 1)).rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = limiter or RateLimiter(global_rate, per_chat_rate)  # Pass a RedisRateLimiter to share budgets
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+
+    def call(self, method, data=None, files=None, chat_id=None):
+        # Only methods sending to a chat are paced; calls without one (getFile) leave the send budget alone
+        url = f"{self.api_url}/{method}"
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                self.limiter.acquire(chat_id)
+
+            # **Rewind Uploads so Every Attempt Sends the Whole File**
+            for value in (files or {}).values():
+                file_obj = value[1] if isinstance(value, tuple) else value
+                file_obj.seek(0)
+
+            try:
+                response = self.session.post(url, data=data, files=files, timeout=self.timeout)
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(2 ** attempt, 30)
+                logger.warning(f"Telegram {method} failed ({e}), retrying in {delay} seconds")
+                time.sleep(delay)
+                continue
+
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = {"ok": False, "description": response.text}
+
+            if response.ok and payload.get("ok"):
+                return payload.get("result")
+
+            retry_after = (payload.get("parameters") or {}).get("retry_after")
+            error = TelegramError(payload.get("description", response.text), response.status_code, retry_after)
+
+            if response.status_code == 429 and attempt < self.max_retries:
+                delay = retry_after or min(2 ** attempt, 30)
+                logger.warning(f"Telegram {method} rate limited, retrying in {delay} seconds")
+                if chat_id is not None:
+                    self.limiter.penalize(chat_id, delay)
+                else:
+                    time.sleep(delay)
+                continue
+            if response.status_code >= 500 and attempt < self.max_retries:
+                delay = min(2 ** attempt, 30)
+                logger.warning(f"Telegram {method} returned {response.status_code}, retrying in {delay} seconds")
+                time.sleep(delay)
+                continue
+            raise error
+
+    def send_message(self, chat_id, text, parse_mode="HTML"):
+        data = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
+        return self.call("sendMessage", data=data, chat_id=chat_id)
+
+    def edit_message_text(self, chat_id, message_id, text, parse_mode="HTML"):
+        data = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": parse_mode}
+        return self.call("editMessageText", data=data, chat_id=chat_id)
+
+    def send_document(self, chat_id, document, caption=None, filename=None, parse_mode="HTML"):
+        # document is either an open binary file or the file_id of an already uploaded document
+        data = {"chat_id": chat_id, "parse_mode": parse_mode}
+        if caption:
+            data["caption"] = caption
+        if isinstance(document, str):
+            data["document"] = document
+            return self.call("sendDocument", data=data, chat_id=chat_id)
+        files = {"document": (filename, document) if filename else document}
+        return self.call("sendDocument", data=data, files=files, chat_id=chat_id)
+
+    def send_media_group(self, chat_id, documents):
+        # documents is a list of (file_name, file object or file_id, caption) tuples
+        media = []
+        files = {}
+        for index, (file_name, document, caption) in enumerate(documents):
+            item = {"type": "document", "media": document}
+            if not isinstance(document, str):
+                attach_name = f"file{index}"
+                files[attach_name] = (file_name, document)
+                item["media"] = f"attach://{attach_name}"
+            if caption:
+                item["caption"] = caption
+                item["parse_mode"] = "HTML"
+            media.append(item)
+        data = {"chat_id": chat_id, "media": json.dumps(media, ensure_ascii=False)}
+        return self.call("sendMediaGroup", data=data, files=files or None, chat_id=chat_id)
+
+    def get_file(self, file_id):
+        return self.call("getFile", data={"file_id": file_id})
+
+    def download_file(self, file_id, destination, chunk_size=64 * 1024):
+        # Streams the file in chunks over the pooled session into a path or a writable binary file
+        # object and returns the number of bytes written
+        file_path = self.get_file(file_id)["file_path"]
+        url = f"{self.file_url}/{file_path}"
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    if isinstance(destination, str):
+                        # Renamed into place when complete, so an interrupted download never looks finished
+                        with open(f"{destination}.part", "wb") as f:
+                            written = self._write_chunks(response, f, chunk_size)
+                        os.replace(f"{destination}.part", destination)
+                    else:
+                        destination.seek(0)
+                        destination.truncate()
+                        written = self._write_chunks(response, destination, chunk_size)
+                        destination.seek(0)
+                return written
+            except requests.RequestException as e:
+                client_error = e.response is not None and e.response.status_code < 500
+                if client_error or attempt == self.max_retries:
+                    raise
+                delay = min(2 ** attempt, 30)
+                logger.warning(f"Download of {file_path} failed ({e}), retrying in {delay} seconds")
+                time.sleep(delay)
+
+    @staticmethod
+    def _write_chunks(response, f, chunk_size):
+        written = 0
+        for chunk in response.iter_content(chunk_size):
+            f.write(chunk)
+            written += len(chunk)
+        return written
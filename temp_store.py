@@ -0,0 +1,202 @@
+import io
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# **Error Raised when the Temp Volume Stays over Its Quota**
+class TempStoreFullError(Exception):
+    pass
+
+
+# **File Kept in Memory until It Outgrows max_size, then Moved to a Named File under root**
+# Spilled files are named, so the quota scan of every process sees them; they are deleted on close,
+# and the janitor reclaims those of processes that died.
+class SpooledFile:
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.path = None
+        self._file = io.BytesIO()
+
+    def write(self, data):
+        if self.path is None and self._file.tell() + len(data) > self.max_size:
+            self._spill()
+        return self._file.write(data)
+
+    def _spill(self):
+        fd, path = tempfile.mkstemp(prefix="spool_", dir=self.root)
+        spilled = os.fdopen(fd, "w+b")
+        spilled.write(self._file.getvalue())
+        spilled.seek(self._file.tell())
+        self._file, self.path = spilled, path
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def truncate(self, size=None):
+        return self._file.truncate(size)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass  # Already reclaimed by the janitor
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# **Temporary Storage on the Shared Temp Volume**
+# Every job keeps its files in its own top-level entry (a folder or file) under root. Small
+# payloads are spooled in memory and only spill to disk past spool_bytes. Before a large file
+# is written, callers wait until the files on the volume leave room for it under quota_bytes,
+# so a burst of uploads queues up instead of filling the disk. A janitor thread removes entries
+# nothing has written to for max_age seconds, left behind by crashed bots and workers.
+class TempStore:
+    USAGE_TTL = 1.0  # Seconds a measured usage is reused, scanning the volume on every call is wasteful
+    DEFAULT_QUOTA_SHARE = 0.8  # Share of the volume's free space (plus the temp files on it) used as the default quota
+
+    def __init__(self, root, quota_bytes=-1, spool_bytes=8 * 1024 * 1024, max_age=6 * 3600):
+        self.root = root
+        self.spool_bytes = spool_bytes
+        self.max_age = max_age  # 0 disables the janitor
+        self._lock = threading.Lock()
+        self._usage = None
+        self._usage_time = 0.0
+        os.makedirs(root, exist_ok=True)
+        self.quota_bytes = quota_bytes if quota_bytes >= 0 else self.default_quota()  # 0 disables the quota
+
+    def default_quota(self):
+        # What the temp files may use when nothing is configured, measured when the process starts
+        quota = int((self.usage() + shutil.disk_usage(self.root).free) * self.DEFAULT_QUOTA_SHARE)
+        logger.info(f"Temp storage quota set to {quota // (1024 * 1024)} MB from the free space on {self.root}")
+        return quota
+
+    # **Spooling**
+    def spool(self):
+        return SpooledFile(self.root, self.spool_bytes)
+
+    # **Quota**
+    def usage(self):
+        with self._lock:
+            if self._usage is None or time.time() - self._usage_time > self.USAGE_TTL:
+                self._usage = sum(size for _, size, _ in self._scan())
+                self._usage_time = time.time()
+            return self._usage
+
+    def wait_for_space(self, size, timeout=300, poll=0.5):
+        # Blocks until size more bytes fit under the quota. Processes check independently, so files
+        # started by several processes at the same moment can overshoot the quota between them.
+        if not self.quota_bytes:
+            return
+        deadline = time.time() + timeout
+        logged = False
+        while self.usage() + size > self.quota_bytes:
+            if time.time() >= deadline:
+                raise TempStoreFullError(
+                    f"temp storage is full ({self.usage() // (1024 * 1024)} of "
+                    f"{self.quota_bytes // (1024 * 1024)} MB used)"
+                )
+            if not logged:
+                logger.info(f"Temp storage over quota, waiting for room for {size} bytes")
+                logged = True
+            time.sleep(poll)
+        with self._lock:
+            if self._usage is not None:
+                self._usage += size  # Count the file about to be written until the next scan
+
+    # **Cleanup**
+    def remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def remove_if_empty(self, folder):
+        if os.path.abspath(folder) == os.path.abspath(self.root):
+            return False
+        try:
+            os.rmdir(folder)
+            return True
+        except OSError:
+            return False  # Missing, not empty (e.g. an album still being collected) or busy
+
+    def _scan(self):
+        # Yields (path, bytes, newest modification time) of every top-level entry
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                size, newest = stat.st_size, stat.st_mtime
+                if entry.is_dir(follow_symlinks=False):
+                    size = 0  # Only file contents count towards the quota
+                    for folder, _, files in os.walk(entry.path):
+                        for name in files:
+                            file_stat = os.stat(os.path.join(folder, name), follow_symlinks=False)
+                            size += file_stat.st_size
+                            newest = max(newest, file_stat.st_mtime)
+            except FileNotFoundError:
+                continue  # Removed by its job while scanning
+            yield entry.path, size, newest
+
+    def reclaim(self):
+        # Removes entries older than max_age and returns (entries, bytes) reclaimed
+        if not self.max_age:
+            return 0, 0
+        cutoff = time.time() - self.max_age
+        removed = reclaimed = 0
+        for path, size, newest in list(self._scan()):
+            if newest >= cutoff:
+                continue
+            try:
+                self.remove(path)
+            except OSError as e:
+                logger.error(f"Error removing orphaned temp entry {path}: {e}")
+                continue
+            removed += 1
+            reclaimed += size
+            logger.info(f"Removed orphaned temp entry {path} ({size} bytes)")
+        return removed, reclaimed
+
+    def start_janitor(self, interval=300):
+        if not self.max_age:
+            return None
+
+        def run():
+            while True:
+                try:
+                    removed, reclaimed = self.reclaim()
+                    if removed:
+                        logger.info(f"Temp janitor reclaimed {removed} entries, {reclaimed} bytes")
+                except Exception as e:
+                    logger.error(f"Error in temp janitor: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="temp-janitor", daemon=True)
+        thread.start()
+        return thread
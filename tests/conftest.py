@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# **Make the Flat Modules Importable and Keep Them off /app**
+# tasks.py reads its configuration at import time, so the environment is set before any test imports it.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_temp_root = tempfile.mkdtemp(prefix="resizer-tests-")
+os.environ.setdefault("BOT_TOKEN", "test-token")
+os.environ.setdefault("TEMP_DIR", os.path.join(_temp_root, "temp"))
+os.environ.setdefault("CACHE_DIR", os.path.join(_temp_root, "cache"))
+os.environ.setdefault("TEMP_QUOTA_BYTES", "0")
+os.environ.setdefault("TEMP_MAX_AGE", "0")
@@ -0,0 +1,90 @@
+import time
+
+import fakeredis
+
+from admission import AdmissionControl
+
+
+class FakeResult:
+    def __init__(self, task_id):
+        self.id = task_id
+
+
+class FakeCeleryApp:
+    def __init__(self):
+        self.sent = []
+
+    def send_task(self, name, args, headers):
+        self.sent.append(args)
+        return FakeResult(f"task-{len(self.sent)}")
+
+
+class FakeTask:
+    name = "tasks.process_images_task"
+
+
+def make_admission(limit=1, ttl=3600, max_wait=0):
+    app = FakeCeleryApp()
+    dropped = []
+    admission = AdmissionControl(
+        fakeredis.FakeRedis(), app, {"images": limit}, ttl=ttl, max_wait=max_wait, on_dropped=dropped.append
+    )
+    return admission, app, dropped
+
+
+def test_jobs_over_the_limit_are_parked_and_dispatched_in_order():
+    admission, app, _ = make_admission(limit=2)
+    results = [admission.submit(FakeTask, "images", 7, [7, f"job{i}"]) for i in range(4)]
+    assert [result is not None for result in results] == [True, True, False, False]
+    assert app.sent == [[7, "job0"], [7, "job1"]]
+
+    admission.release("images", 7)
+    admission.release("images", 7)
+    assert app.sent[2:] == [[7, "job2"], [7, "job3"]]
+
+    admission.release("images", 7)
+    admission.release("images", 7)
+    assert admission.redis.keys("admission:*") == []
+
+
+def test_users_do_not_share_slots():
+    admission, app, _ = make_admission(limit=1)
+    assert admission.submit(FakeTask, "images", 1, [1, "a"]) is not None
+    assert admission.submit(FakeTask, "images", 2, [2, "b"]) is not None
+    assert admission.submit(FakeTask, "images", 1, [1, "c"]) is None
+    assert len(app.sent) == 2
+
+
+def test_parked_jobs_survive_a_running_job_longer_than_the_slot_ttl():
+    admission, app, _ = make_admission(limit=1, ttl=1)
+    admission.submit(FakeTask, "images", 7, [7, "job1"])
+    admission.submit(FakeTask, "images", 7, [7, "job2"])
+    time.sleep(1.5)
+
+    admission.release("images", 7)
+    assert app.sent == [[7, "job1"], [7, "job2"]]
+
+
+def test_reaper_admits_parked_jobs_once_a_crashed_slot_expires():
+    admission, app, _ = make_admission(limit=1, ttl=1)
+    admission.submit(FakeTask, "images", 7, [7, "crashed"])
+    admission.submit(FakeTask, "images", 7, [7, "parked"])
+    assert admission.reap() == (0, 0)
+
+    time.sleep(1.5)
+    assert admission.reap() == (0, 1)
+    assert app.sent[-1] == [7, "parked"]
+
+
+def test_reaper_drops_jobs_parked_too_long_and_reports_them():
+    admission, app, dropped = make_admission(limit=1, max_wait=1)
+    admission.submit(FakeTask, "images", 7, [7, "running"])
+    admission.submit(FakeTask, "images", 7, [7, "stale"])
+    time.sleep(1.5)
+    admission.submit(FakeTask, "images", 7, [7, "fresh"])
+
+    assert admission.reap() == (1, 0)
+    assert [job["args"] for job in dropped] == [[7, "stale"]]
+
+    admission.release("images", 7)
+    assert app.sent[-1] == [7, "fresh"]
@@ -0,0 +1,53 @@
+import time
+
+import fakeredis
+
+from albums import AlbumBuffer
+
+
+def make_replicas(debounce=0.2):
+    server = fakeredis.FakeServer()
+    return [AlbumBuffer(fakeredis.FakeRedis(server=server), debounce) for _ in range(2)]
+
+
+def add_photo(buffer, name, folder, caption=None):
+    album_folder = buffer.open("group", 7, folder, caption)
+    buffer.add("group", [{"file_name": name}])
+    buffer.close("group")
+    return album_folder
+
+
+def test_photos_from_two_replicas_form_one_album_claimed_once():
+    first, second = make_replicas()
+    assert add_photo(first, "a.jpg", "/tmp/first") == "/tmp/first"
+    assert add_photo(second, "b.jpg", "/tmp/second", caption="small") == "/tmp/first"
+
+    album, wait = first.claim("group")
+    assert album is None and 0 < wait <= 0.2
+
+    time.sleep(0.3)
+    claims = [first.claim("group"), second.claim("group")]
+    albums = [album for album, _ in claims if album is not None]
+    assert len(albums) == 1
+    assert albums[0] == {
+        "user_id": 7, "folder": "/tmp/first", "caption": "small",
+        "images": [{"file_name": "a.jpg"}, {"file_name": "b.jpg"}],
+    }
+    assert (None, None) in claims
+    assert first.redis.keys("album:*") == []
+
+
+def test_album_is_not_claimed_while_a_download_is_running():
+    first, second = make_replicas(debounce=0.1)
+    add_photo(first, "a.jpg", "/tmp/first")
+    second.open("group", 7, "/tmp/second")  # Still downloading its photo
+    time.sleep(0.2)
+
+    album, wait = first.claim("group")
+    assert album is None and wait == 0.1
+
+    second.add("group", [{"file_name": "b.jpg"}])
+    second.close("group")
+    time.sleep(0.2)
+    album, _ = second.claim("group")
+    assert [image["file_name"] for image in album["images"]] == ["a.jpg", "b.jpg"]
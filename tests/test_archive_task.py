@@ -0,0 +1,117 @@
+import io
+import os
+import threading
+import time
+import zipfile
+
+import fakeredis
+import pytest
+from PIL import Image
+
+import tasks
+from cache import ResultCache
+from stats_store import RedisStats
+
+
+class FakeBotApi:
+    def __init__(self, sent):
+        self.sent = sent
+
+    def edit_message_text(self, chat_id, message_id, text):
+        pass
+
+    def send_document(self, chat_id, document, caption=None, filename=None):
+        with zipfile.ZipFile(document) as zf:
+            self.sent.append(zf.namelist())
+        return {"document": {"file_id": "file-id"}}
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    # An eager worker with Redis, the result cache and Telegram replaced by local stand-ins;
+    # returns the member names of every archive sent back
+    redis_client = fakeredis.FakeRedis()
+    stats = RedisStats(redis_client)
+    sent = []
+
+    def send_document(chat_id, file_path, caption):
+        with zipfile.ZipFile(file_path) as zf:
+            sent.append(zf.namelist())
+        return "file-id"
+
+    monkeypatch.setattr(tasks, "redis_client", redis_client)
+    monkeypatch.setattr(tasks, "stats", stats)
+    monkeypatch.setattr(tasks, "result_cache", ResultCache(str(tmp_path / "cache"), 64 * 1024 * 1024, None, stats))
+    monkeypatch.setattr(tasks, "bot_api", FakeBotApi(sent))
+    monkeypatch.setattr(tasks, "send_document", send_document)
+    monkeypatch.setattr(tasks, "send_message", lambda chat_id, text: None)
+    monkeypatch.setattr(tasks, "CHECKPOINT_TTL", 0)
+    return sent
+
+
+def make_archive(folder, names):
+    os.makedirs(folder)
+    path = os.path.join(folder, "photos.zip")
+    with zipfile.ZipFile(path, "w") as zf:
+        for i, name in enumerate(names):
+            buffer = io.BytesIO()
+            Image.new("RGB", (300, 300), (i * 20 % 255, 100, 50)).save(buffer, "JPEG")
+            zf.writestr(name, buffer.getvalue())
+    return path
+
+
+@pytest.mark.parametrize("budget", [768 * 1024 * 1024, 0])
+def test_archive_images_are_resized_in_parallel_with_or_without_a_memory_budget(worker, tmp_path, monkeypatch,
+                                                                                 budget):
+    monkeypatch.setattr(tasks, "TASK_MEMORY_BUDGET", budget)
+    monkeypatch.setattr(tasks, "ARCHIVE_WORKERS", 4)
+    running = []
+    peak = [0]
+    lock = threading.Lock()
+    resize = tasks.resize_variants_cached
+
+    def slow_resize(*args, **kwargs):
+        with lock:
+            running.append(1)
+            peak[0] = max(peak[0], len(running))
+        time.sleep(0.05)
+        try:
+            return resize(*args, **kwargs)
+        finally:
+            with lock:
+                running.pop()
+
+    monkeypatch.setattr(tasks, "resize_variants_cached", slow_resize)
+    archive_path = make_archive(str(tmp_path / "job"), [f"img{i:02}.jpg" for i in range(12)])
+    status = tasks.process_archive_task.apply(args=[1, archive_path, 900, 1200, 0.15]).result
+
+    assert status["success"] == 12
+    assert peak[0] == 4
+
+
+def test_members_with_the_same_file_name_keep_their_folders(worker, tmp_path):
+    names = ["d1/p.jpg", "d2/p.jpg", "p.jpg", "P.jpg", "../../p.jpg"]
+    archive_path = make_archive(str(tmp_path / "job"), names)
+    status = tasks.process_archive_task.apply(args=[1, archive_path, 900, 1200, 0.15]).result
+
+    assert status["success"] == 5
+    timestamp = worker[0][0].split("/")[-1].split("_")[1]
+    assert sorted(worker[0]) == sorted([
+        f"d1/resized_{timestamp}_p.jpg", f"d2/resized_{timestamp}_p.jpg", f"resized_{timestamp}_p.jpg",
+        f"resized_{timestamp}_P_2.jpg", f"resized_{timestamp}_p_3.jpg",
+    ])
+
+
+def test_album_documents_with_the_same_file_name_get_distinct_names(worker, tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, "ALBUM_ZIP_THRESHOLD", 1)
+    folder = tmp_path / "album"
+    paths = []
+    for i in range(3):
+        os.makedirs(folder / str(i))
+        path = str(folder / str(i) / "photo.jpg")
+        Image.new("RGB", (300, 300), (i * 60, 100, 50)).save(path)
+        paths.append(path)
+    tasks.process_images_task(1, paths, 900, 1200, 0.15, None, True)
+
+    names = sorted(name.split("_", 2)[2] for name in worker[0])
+    assert names == ["photo.jpg", "photo_2.jpg", "photo_3.jpg"]
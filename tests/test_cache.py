@@ -0,0 +1,17 @@
+import fakeredis
+
+import cache
+from cache import ResultCache
+
+
+def test_results_of_an_older_output_version_are_not_served(tmp_path, monkeypatch):
+    result_cache = ResultCache(str(tmp_path), 1024 * 1024, fakeredis.FakeRedis())
+    old_key = result_cache.key(b"gif", 900, 1200, {"format": "JPEG"})
+    result_cache.put(old_key, b"flattened")
+    result_cache.set_file_id(old_key, "old-file-id")
+
+    monkeypatch.setattr(cache, "OUTPUT_VERSION", cache.OUTPUT_VERSION + 1)
+    new_key = result_cache.key(b"gif", 900, 1200, {"format": "JPEG"})
+    assert new_key != old_key
+    assert result_cache.get(new_key) is None
+    assert result_cache.get_file_id(new_key) is None
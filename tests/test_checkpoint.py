@@ -0,0 +1,111 @@
+import io
+import os
+import re
+import zipfile
+
+import fakeredis
+import pytest
+from PIL import Image
+
+import tasks
+from cache import ResultCache
+from checkpoint import ArchiveCheckpoint
+from stats_store import RedisStats
+
+IMAGE_COUNT = 12
+
+
+class FakeBotApi:
+    def edit_message_text(self, chat_id, message_id, text):
+        pass
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    # An eager worker with Redis, the result cache and Telegram replaced by local stand-ins
+    redis_client = fakeredis.FakeRedis()
+    stats = RedisStats(redis_client)
+    sent = []  # (attempt, part file name, members) per uploaded part
+
+    def send_document(chat_id, file_path, caption):
+        with zipfile.ZipFile(file_path) as zf:
+            attempt = int(redis_client.hget("checkpoint:resumed-job", ArchiveCheckpoint.ATTEMPTS))
+            sent.append((attempt, os.path.basename(file_path), zf.namelist()))
+        return "file-id"
+
+    monkeypatch.setattr(tasks, "redis_client", redis_client)
+    monkeypatch.setattr(tasks, "stats", stats)
+    monkeypatch.setattr(tasks, "result_cache", ResultCache(str(tmp_path / "cache"), 64 * 1024 * 1024, None, stats))
+    monkeypatch.setattr(tasks, "bot_api", FakeBotApi())
+    monkeypatch.setattr(tasks, "send_document", send_document)
+    monkeypatch.setattr(tasks, "send_message", lambda chat_id, text: None)
+    monkeypatch.setattr(tasks, "PART_MAX_BYTES", 40 * 1024)  # About two resized images per part
+    monkeypatch.setattr(tasks, "ARCHIVE_WORKERS", 1)
+    monkeypatch.setattr(tasks, "CHECKPOINT_TTL", 3600)
+    return redis_client, sent
+
+
+def make_archive(folder):
+    os.makedirs(folder)
+    path = os.path.join(folder, "photos.zip")
+    with zipfile.ZipFile(path, "w") as zf:
+        for i in range(IMAGE_COUNT):
+            buffer = io.BytesIO()
+            Image.effect_noise((300, 300), 40 + i).convert("RGB").save(buffer, "JPEG")
+            zf.writestr(f"dir/img{i:02}.jpg", buffer.getvalue())
+    return path
+
+
+def test_archive_job_resumes_after_a_failure_with_the_next_part_number(worker, tmp_path, monkeypatch):
+    redis_client, sent = worker
+    archive_path = make_archive(str(tmp_path / "job"))
+
+    # **Fail the First Attempt after a Few Parts Were Uploaded**
+    updates = []
+    update = tasks.ProgressMessage.update
+
+    def failing_update(self, text, force=False):
+        updates.append(text)
+        if len(updates) == 7:
+            raise ConnectionError("worker lost its connection")
+        return update(self, text, force)
+
+    monkeypatch.setattr(tasks.ProgressMessage, "update", failing_update)
+    result = tasks.process_archive_task.apply(
+        args=[1, archive_path, 900, 1200, 0.15, None, 99], task_id="resumed-job"
+    )
+
+    assert result.successful()
+    assert result.result["success"] == IMAGE_COUNT and result.result["errors"] == 0
+
+    assert "⏳ <b>Processing interrupted</b>, retrying shortly..." in updates
+
+    # **Every Part Is Sent Once, Numbered on from the Last Part of the Failed Attempt**
+    attempts = [attempt for attempt, _, _ in sent]
+    numbers = [int(re.search(r"_part(\d+)\.zip$", name).group(1)) for _, name, _ in sent]
+    assert attempts[0] == 1 and attempts[-1] == 2 and attempts == sorted(attempts)
+    assert numbers == list(range(1, len(sent) + 1))
+
+    # **Images in Parts the User Already Received Are Not Sent Again**
+    members = [member for _, _, names in sent for member in names]
+    assert len(members) == len(set(members)) == IMAGE_COUNT
+
+    # **The Checkpoint Is Gone once the Job Finished**
+    assert redis_client.keys("checkpoint:*") == []
+
+
+def test_checkpoint_records_members_and_uploaded_parts():
+    redis_client = fakeredis.FakeRedis()
+    checkpoint = ArchiveCheckpoint(redis_client, "job", ttl=60)
+    assert checkpoint.begin(1000) == (1, 1000, 0, {})
+
+    checkpoint.mark_member("a.jpg", "resized", 1)
+    checkpoint.mark_member("b.jpg", "skipped")
+    checkpoint.mark_part_uploaded(1)
+
+    attempts, timestamp, uploaded_parts, members = ArchiveCheckpoint(redis_client, "job", ttl=60).begin(2000)
+    assert (attempts, timestamp, uploaded_parts) == (2, 1000, 1)
+    assert members == {"a.jpg": {"status": "resized", "part": 1}, "b.jpg": {"status": "skipped", "part": None}}
+
+    checkpoint.clear()
+    assert redis_client.keys("checkpoint:*") == []
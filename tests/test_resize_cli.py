@@ -0,0 +1,31 @@
+import io
+import os
+import zipfile
+
+from PIL import Image
+
+from resize_cli import collect_jobs
+
+
+def save_image(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", (10, 10), "red").save(path)
+
+
+def test_outputs_use_plain_stems_unless_two_images_share_one(tmp_path):
+    folder = tmp_path / "in"
+    for name in ("a.jpg", "a.png", "b.jpg", "photos/c.jpg"):
+        save_image(str(folder / name))
+    buffer = io.BytesIO()
+    Image.new("RGB", (10, 10), "blue").save(buffer, "PNG")
+    with zipfile.ZipFile(folder / "photos.zip", "w") as zf:
+        for name in ("c.jpg", "d.jpg", "../../escaped.jpg", "/abs/e.jpg"):
+            zf.writestr(name, buffer.getvalue())
+
+    jobs = collect_jobs([str(folder), str(folder / "b.jpg")])
+    outputs = sorted(relative_stem for _, _, relative_stem in jobs)
+    assert outputs == sorted([
+        "a", "a.png", "b",
+        os.path.join("photos", "c"), os.path.join("photos", "d"), os.path.join("photos", "abs", "e"),
+        os.path.join("photos", "c.jpg"),
+    ])
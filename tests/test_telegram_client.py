@@ -0,0 +1,43 @@
+from telegram_client import TelegramClient
+
+
+class FakeResponse:
+    ok = True
+    status_code = 200
+    text = ""
+
+    def json(self):
+        return {"ok": True, "result": {"file_path": "photos/a.jpg", "message_id": 1}}
+
+
+class FakeSession:
+    def __init__(self):
+        self.calls = []
+
+    def post(self, url, data=None, files=None, timeout=None):
+        self.calls.append(url.rsplit("/", 1)[-1])
+        return FakeResponse()
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.acquired = []
+
+    def acquire(self, chat_id=None):
+        self.acquired.append(chat_id)
+
+    def penalize(self, chat_id, retry_after):
+        pass
+
+
+def test_only_sends_to_a_chat_take_from_the_send_budget():
+    limiter = RecordingLimiter()
+    session = FakeSession()
+    client = TelegramClient("https://api.example/botTOKEN", session=session, limiter=limiter)
+
+    for _ in range(10):
+        client.get_file("file-id")
+    client.send_message(42, "done")
+
+    assert session.calls == ["getFile"] * 10 + ["sendMessage"]
+    assert limiter.acquired == [42]